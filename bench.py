@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of p.py. Eagle and WordPress are replaced by local stand-ins,
+# so runs can be repeated and compared without touching production
+
+import os
+import sys
+import json
+import time
+import random
+import re
+import argparse
+import tempfile
+import hashlib
+import gzip
+import resource
+import tracemalloc
+import threading
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+def eagleDate(date):
+	# 2020-02-01T12:30:00.000+11:00
+	return date.strftime('%Y-%m-%dT%H:%M:%S.000+00:00')
+
+
+class Catalogue:
+	# properties on Eagle side and posts on WordPress side
+	def __init__(self, args, eagleURL, siteURL):
+		self.args = args
+		self.eagleURL = eagleURL
+		self.siteURL = siteURL
+		self.lock = threading.Lock()
+		self.image = os.urandom(args.image_size)
+		self.updated = datetime(2020, 1, 1, tzinfo=timezone.utc)
+		self.properties = [self.property(i) for i in range(args.properties)]
+		self.index = {item['id']: item for item in self.properties}
+		self.posts = {}
+		self.media = set()
+		self.lastID = 0
+
+	def property(self, i):
+		crmID = str(100000 + i)
+		links = lambda name: {'links': {'related': '%s/api/v2/properties/%s/%s' % (self.eagleURL, crmID, name)}}
+		return {
+			'id': crmID,
+			'type': 'properties',
+			'attributes': {
+				'status': 'Active',
+				'sale_or_rent': random.choice(['Sale', 'Rent']),
+				'updated_at': eagleDate(self.updated + timedelta(minutes=i)),
+				'primary_image': '%s/media/%s-0.jpg' % (self.eagleURL, crmID),
+				'full_address': '%d Bench Street, Melbourne' % i,
+				'formatted_address_line_1': '%d Bench Street' % i,
+				'state': 'VIC',
+				'postcode': '3000',
+				'suburb': 'Melbourne',
+				'municipality': 'Melbourne',
+				'headline': 'Property %d' % i,
+				'description': 'Description of property %d. ' % i * 20,
+				'indoor_features': 'Dishwasher, Built-in wardrobes',
+				'heating_cooling_features': 'Split system',
+				'eco_friendly_features': '',
+				'outdoor_features': 'Balcony',
+				'other_features': None,
+				'property_type': 'Apartment',
+				'land_size': '', 'house_size_units': '', 'land_size_units': '',
+				'bedrooms': 2, 'bathrooms': 1, 'garage_spaces': 1,
+				'latitude': -37.81, 'longitude': 144.96,
+				'video_url': '',
+				'alt_to_price': '', 'price': '650000.0', 'advertised_price': '',
+				'agent_ids': ['816']
+			},
+			'relationships': {name: links(name) for name in ['images', 'documents', 'inspections', 'floorplans']}
+		}
+
+	def touch(self, count):
+		# the first count properties were edited in CRM
+		with self.lock:
+			self.updated += timedelta(days=1)
+			for i, item in enumerate(self.properties[:count]):
+				item['attributes']['updated_at'] = eagleDate(self.updated + timedelta(minutes=i))
+				item['attributes']['headline'] += '!'
+
+	def nextID(self):
+		with self.lock:
+			self.lastID += 1
+			return self.lastID
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def reply(self, status, body, headers={}):
+		data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Length', str(len(data)))
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def readBody(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		return self.rfile.read(length) if length else b''
+
+	def route(self, method):
+		self.catalogue = self.server.catalogue
+		args = self.catalogue.args
+		url = urlsplit(self.path)
+		body = self.readBody()
+
+		if not url.path.startswith('/bench/'):
+			# every request waits and some of them fail, like a loaded server
+			time.sleep(args.latency)
+			if random.random() < args.failure_rate:
+				self.reply(503, {'error': 'bench failure'})
+				return
+
+		self.dispatch(method, url.path, parse_qs(url.query), body)
+
+	def do_GET(self):
+		self.route('GET')
+
+	def do_POST(self):
+		self.route('POST')
+
+	def do_DELETE(self):
+		self.route('DELETE')
+
+
+class EagleHandler(BenchHandler):
+	def dispatch(self, method, path, query, body):
+		catalogue = self.catalogue
+		args = catalogue.args
+
+		if path == '/bench/touch':
+			catalogue.touch(int(json.loads(body)['count']))
+			self.reply(200, {})
+		elif path == '/api/v2/sessions':
+			self.reply(201, {'data': {'type': 'sessions', 'attributes': {'token': 'bench', 'expires_in': 3600}}})
+		elif path == '/api/v2/properties':
+			# Eagle limits the page size
+			limit = min(int(query.get('page[limit]', [60])[0]), args.page_size)
+			offset = int(query.get('page[offset]', [0])[0])
+			items = catalogue.properties
+			if query.get('sort', [''])[0] == '-updated_at':
+				items = sorted(items, key=lambda item: item['attributes']['updated_at'], reverse=True)
+			self.reply(200, {'data': items[offset:offset + limit], 'meta': {'total': len(items)}})
+		elif path == '/api/v2/agents':
+			self.reply(200, {'data': []})
+		elif re.match(r'^/api/v2/properties/\d+$', path):
+			item = catalogue.index.get(path.split('/')[-1])
+			self.reply(200, {'data': item}) if item else self.reply(404, {'errors': [{'detail': 'Not found'}]})
+		elif re.match(r'^/api/v2/properties/\d+/\w+$', path):
+			crmID, name = path.split('/')[-2:]
+			self.reply(200, {'data': self.resources(crmID, name)})
+		elif path.startswith('/media/'):
+			etag = '"%s"' % path
+			if self.headers.get('If-None-Match') == etag:
+				self.reply(304, b'', {'ETag': etag})
+			else:
+				# the same bytes for every url would be deduplicated, make every file unique
+				self.reply(200, path.encode('utf-8') + catalogue.image, {'ETag': etag, 'Content-Type': 'image/jpeg'})
+		else:
+			self.reply(404, {'errors': [{'detail': 'Unknown route %s %s' % (method, path)}]})
+
+	def resources(self, crmID, name):
+		base = self.catalogue.eagleURL
+		if name == 'images':
+			return [{'id': '%s-%d' % (crmID, i), 'type': 'images', 'attributes': {'url': '%s/media/%s-%d.jpg' % (base, crmID, i)}} for i in range(1, self.catalogue.args.images + 1)]
+		if name == 'inspections':
+			return [{'id': crmID, 'type': 'inspections', 'attributes': {'start_datetime': '2020-02-01T12:30:00.000+11:00', 'end_datetime': '2020-02-01T13:00:00.000+11:00'}}]
+
+		return []
+
+
+class SiteHandler(BenchHandler):
+	def dispatch(self, method, path, query, body):
+		catalogue = self.catalogue
+		payload = json.loads(body) if body and path != '/wp-json/wp/v2/media' else {}
+
+		if path == '/wp-json/wp/v2/property' and method == 'GET':
+			perPage = int(payload.get('per_page') or query.get('per_page', [10])[0])
+			page = int(payload.get('page') or query.get('page', [1])[0])
+			with catalogue.lock:
+				posts = list(catalogue.posts.values())
+			pages = max(1, -(-len(posts) // perPage))
+			if page > pages:
+				self.reply(400, {'code': 'rest_post_invalid_page_number'})
+				return
+			posts = posts[(page - 1) * perPage:page * perPage]
+			if '_fields' in query:
+				fields = query['_fields'][0].split(',')
+				posts = [{key: post[key] for key in fields if key in post} for post in posts]
+			self.reply(200, posts, {'X-WP-Total': str(len(catalogue.posts)), 'X-WP-TotalPages': str(pages)})
+		elif path == '/wp-json/wp/v2/property' and method == 'POST':
+			post = dict(payload, id=catalogue.nextID())
+			post['link'] = '%s/property/%d' % (catalogue.siteURL, post['id'])
+			with catalogue.lock:
+				catalogue.posts[post['id']] = post
+			self.reply(201, post)
+		elif re.match(r'^/wp-json/wp/v2/property/\d+$', path):
+			postID = int(path.split('/')[-1])
+			with catalogue.lock:
+				post = catalogue.posts.get(postID)
+				if post and method == 'POST':
+					post.update(payload)
+				elif post and method == 'DELETE':
+					del catalogue.posts[postID]
+					post = dict(post, status='trash')
+			self.reply(200, post) if post else self.reply(404, {'code': 'rest_post_invalid_id'})
+		elif path.startswith('/wp-json/wp/v2/property-terms/'):
+			self.reply(200, {})
+		elif path == '/wp-json/wp/v2/media':
+			mediaID = catalogue.nextID()
+			with catalogue.lock:
+				catalogue.media.add(mediaID)
+			self.reply(201, {'id': mediaID})
+		elif re.match(r'^/wp-json/wp/v2/media/\d+$', path) or (re.match(r'^/wp-json/crm-sync/v1/media/\d+$', path) and catalogue.args.snapshot):
+			self.reply(*self.media(method, int(path.split('/')[-1])))
+		elif path == '/wp-json/batch/v1':
+			responses = []
+			for item in payload['requests']:
+				if item['path'].startswith('/crm-sync/v1/media/') and catalogue.args.snapshot:
+					status, result = self.media(item['method'], int(re.search(r'/media/(\d+)', item['path']).group(1)))
+				elif item['path'].startswith('/wp/v2/media/'):
+					# as in WordPress, attachments controller doesn't allow batching
+					status, result = (400, {'code': 'rest_batch_not_allowed'})
+				else:
+					status, result = (404, {'code': 'rest_no_route'})
+				responses.append({'status': status, 'body': result})
+			self.reply(207, {'responses': responses})
+		elif path == '/wp-json/crm-sync/v1/snapshot' and catalogue.args.snapshot:
+			# companion plugin
+			fields = ['id', 'crm_id', 'crm_updated', 'property_status', '_thumbnail_id', '_thumbnail_name', 'crm_image_ids', 'fave_property_images', 'crm_attachment_ids', 'fave_attachments']
+			with catalogue.lock:
+				posts = [{key: post.get(key) for key in fields} for post in catalogue.posts.values()]
+			data = json.dumps(posts).encode('utf-8')
+			etag = '"%s"' % hashlib.md5(data).hexdigest()
+			if self.headers.get('If-None-Match') == etag:
+				self.reply(304, b'', {'ETag': etag})
+			elif 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+				self.reply(200, gzip.compress(data), {'ETag': etag, 'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+			else:
+				self.reply(200, data, {'ETag': etag, 'Content-Type': 'application/json'})
+		elif path == '/wp-json/wp/v2/houzez_agent':
+			self.reply(200, [], {'X-WP-Total': '0', 'X-WP-TotalPages': '1'})
+		else:
+			self.reply(404, {'code': 'rest_no_route', 'message': 'Unknown route %s %s' % (method, path)})
+
+	def media(self, method, mediaID):
+		with self.catalogue.lock:
+			if mediaID not in self.catalogue.media:
+				return (404, {'code': 'rest_post_invalid_id'})
+			if method == 'DELETE':
+				self.catalogue.media.discard(mediaID)
+				return (200, {'deleted': True, 'previous': {'id': mediaID}})
+
+		return (200, {'id': mediaID})
+
+
+class BenchServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, address):
+		# client closed keep-alive connection, e.g. after a failed attempt
+		if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+			super().handle_error(request, address)
+
+
+def serve(args, ports):
+	# both stand-ins live in their own process, so they don't take CPU and memory from the measured run
+	random.seed(args.seed)
+	eagle = BenchServer(('127.0.0.1', 0), EagleHandler)
+	site = BenchServer(('127.0.0.1', 0), SiteHandler)
+	catalogue = Catalogue(args, 'http://127.0.0.1:%d' % eagle.server_port, 'http://127.0.0.1:%d' % site.server_port)
+	eagle.catalogue = catalogue
+	site.catalogue = catalogue
+
+	threading.Thread(target=site.serve_forever, daemon=True).start()
+	ports.put((eagle.server_port, site.server_port))
+	eagle.serve_forever()
+
+
+def measure(name, call, args):
+	import p
+
+	before = p.METRICS.counters.copy()
+	if args.trace_memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	error = None
+
+	try:
+		call()
+	except (p.RequestFailed, SystemExit) as e:
+		error = str(e) or 'exit'
+
+	wall = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+	if args.trace_memory:
+		tracemalloc.stop()
+
+	counted = lambda metric, counters: sum(value for (key, labels), value in counters.items() if key == metric)
+	return {
+		'scenario': name,
+		'wall_seconds': round(wall, 3),
+		'requests': counted('requests_total', p.METRICS.counters) - counted('requests_total', before),
+		'retries': counted('retries_total', p.METRICS.counters) - counted('retries_total', before),
+		'traced_peak_bytes': peak,
+		# peak of the whole process so far, it never goes down
+		'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'error': error
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark p.py against local Eagle and WordPress stand-ins.')
+	parser.add_argument('--properties', type=int, default=500, help='catalogue size')
+	parser.add_argument('--images', type=int, default=5, help='gallery images of every property')
+	parser.add_argument('--image-size', type=int, default=50 * 1024, help='bytes of every image')
+	parser.add_argument('--page-size', type=int, default=60, help='max page size of Eagle list')
+	parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every response')
+	parser.add_argument('--failure-rate', type=float, default=0, help='share of requests answered with 503')
+	parser.add_argument('--no-snapshot', dest='snapshot', action='store_false', help='site without companion snapshot plugin')
+	parser.add_argument('--changed', type=int, default=10, help='properties edited before incremental run')
+	parser.add_argument('--scenarios', default='lists,full,incremental', help='comma separated: lists, full, incremental')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--trace-memory', action='store_true', help='measure Python allocations, makes run slower')
+	parser.add_argument('--output', help='append results to this file as JSON lines')
+	args = parser.parse_args()
+
+	ports = multiprocessing.Queue()
+	server = multiprocessing.Process(target=serve, args=(args, ports), daemon=True)
+	server.start()
+	eaglePort, sitePort = ports.get(timeout=60)
+	eagleURL = 'http://127.0.0.1:%d' % eaglePort
+
+	workdir = tempfile.mkdtemp(prefix='bench-')
+	os.environ.update({
+		'EAGLE_API': eagleURL + '/api/v2',
+		'SITE_DOMAIN': 'http://127.0.0.1:%d' % sitePort,
+		'EAGLE_LOGIN': 'bench', 'EAGLE_PASS': 'bench',
+		'SITE_LOGIN': 'bench', 'SITE_PASS': 'bench',
+		'STATE_DB': os.path.join(workdir, 'sync.sqlite'),
+		'EAGLE_TOKEN_CACHE': os.path.join(workdir, 'eagle_token'),
+		'RETRY_BASE_DELAY': os.getenv('RETRY_BASE_DELAY', '0.05'),
+		'METRICS_PATH': ''
+	})
+	# settings are read when p is imported
+	import p
+	p.DEBUG = False
+	random.seed(args.seed)
+
+	scenarios = {
+		'lists': lambda: (p.getCRMPropertiesList(), p.getSitePropertiesList()),
+		'full': p.checkNewProperties,
+		'incremental': lambda: (p.req('POST', eagleURL + '/bench/touch', data=json.dumps({'count': args.changed})), p.checkNewProperties())
+	}
+
+	settings = {key: value for key, value in vars(args).items() if key not in ['output', 'scenarios']}
+	results = []
+	for name in args.scenarios.split(','):
+		result = measure(name, scenarios[name], args)
+		result.update(settings)
+		results.append(result)
+		print('%-12s %8.2fs %7d requests %5d retries  rss %d KB%s%s' % (name, result['wall_seconds'], result['requests'], result['retries'], result['max_rss_kb'], '  traced peak %d KB' % (result['traced_peak_bytes'] // 1024) if args.trace_memory else '', '  ERROR ' + result['error'] if result['error'] else ''))
+
+	if args.output:
+		with open(args.output, 'a') as file:
+			for result in results:
+				file.write(json.dumps(result) + '\n')
+
+	server.terminate()
+
+
+if __name__ == '__main__':
+	main()
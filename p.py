@@ -3,13 +3,32 @@
 import os
 from dotenv import load_dotenv
 import requests
+from urllib3.exceptions import NewConnectionError
 import re
 import json
 import base64
 from bs4 import BeautifulSoup
 import socket
 import time
-from datetime import datetime
+import random
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import threading
+import argparse
+import difflib
+import html
+import sqlite3
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import hmac
+import heapq
+from itertools import islice
+import fcntl
 
 load_dotenv()
 os.system('clear')
@@ -19,10 +38,93 @@ EAGLE_LOGIN = os.getenv('EAGLE_LOGIN')
 EAGLE_PASS = os.getenv('EAGLE_PASS')
 SITE_LOGIN = os.getenv('SITE_LOGIN')
 SITE_PASS = os.getenv('SITE_PASS')
-SITE_DOMAIN = 'http://savoy' if bool( re.match('^.*local.*$', socket.gethostname()) ) else 'https://www.savoy.com.au'
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 4))
+# retry policy for a single request
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 6))
+RETRY_DEADLINE = float(os.getenv('RETRY_DEADLINE', 300))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+RETRY_STATUSES = [408, 425, 429, 500, 502, 503, 504]
+# of them, statuses which mean the request wasn't handled, so even creating requests can be repeated
+UNHANDLED_STATUSES = [408, 425, 429, 503]
+# properties synced at once
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', 4))
+# max requests in flight per client
+EAGLE_MAX_CONCURRENCY = int(os.getenv('EAGLE_MAX_CONCURRENCY', 8))
+WP_MAX_CONCURRENCY = int(os.getenv('WP_MAX_CONCURRENCY', 4))
+# attachments transferred at once for one property
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', 4))
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# attachments bigger than this are kept in a temporary file instead of memory
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
+# max requests in one call to /batch/v1
+WP_BATCH_LIMIT = 25
+# batch routes which the site doesn't have or doesn't allow in batches
+WP_UNBATCHED = set()
+# seconds between full syncs, which also catch removed properties. Runs in between ask Eagle only for changed ones
+FULL_SYNC_INTERVAL = int(os.getenv('FULL_SYNC_INTERVAL', 24 * 60 * 60))
+# min similarity of descriptions to treat them as the same property in audit
+AUDIT_SIMILARITY = float(os.getenv('AUDIT_SIMILARITY', 0.9))
+# seconds to trust CRM to site agent mapping found by name
+AGENT_TTL = int(os.getenv('AGENT_TTL', 7 * 24 * 60 * 60))
+# min seconds between reloads of CRM and site agent lists when an agent is not found in them
+AGENT_DIRECTORY_TTL = int(os.getenv('AGENT_DIRECTORY_TTL', 15 * 60))
+# Eagle session token is kept here between runs
+EAGLE_TOKEN_CACHE = os.getenv('EAGLE_TOKEN_CACHE', '.eagle_token')
+# lifetime of the token if Eagle doesn't tell it, and how long before expiry to renew it
+EAGLE_TOKEN_TTL = int(os.getenv('EAGLE_TOKEN_TTL', 6 * 60 * 60))
+EAGLE_TOKEN_REFRESH_MARGIN = int(os.getenv('EAGLE_TOKEN_REFRESH_MARGIN', 5 * 60))
+# daemon mode: webhook listener address, shared secret, seconds to collect duplicate events and seconds between change feed polls
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 0))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 5))
+POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', 60))
+# daemon mode: failed properties are queued again, waiting twice longer after every failure up to this many seconds
+REQUEUE_MAX_DELAY = int(os.getenv('REQUEUE_MAX_DELAY', 60 * 60))
+# run metrics are written here at the end of every run, as JSON lines or as Prometheus textfile
+METRICS_PATH = os.getenv('METRICS_PATH', '')
+METRICS_FORMAT = os.getenv('METRICS_FORMAT', 'json')
+# upper bounds of latency histogram buckets in seconds
+METRICS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# lock file which keeps cron runs from overlapping
+LOCK_FILE = os.getenv('LOCK_FILE', 'sync.lock')
+# seconds for syncing properties in one run, the rest waits for the next run. 0 is unlimited
+SYNC_TIME_BUDGET = int(os.getenv('SYNC_TIME_BUDGET', 0))
+# changed properties sorted by priority at once
+PRIORITY_WINDOW = int(os.getenv('PRIORITY_WINDOW', 500))
+# local database with sync state
+STATE_DB = os.getenv('STATE_DB', 'sync.sqlite')
+# max bytes of Eagle sub-resource responses kept in STATE_DB, least recently used go first. 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 64 * 1024 * 1024))
+# requests per second to one host for every class of endpoints, 0 or missing is unlimited. Rates go down on errors and slow responses and up again while the host is healthy
+RATE_LIMITS = dict((name.strip(), float(rate)) for name, sep, rate in (pair.partition('=') for pair in os.getenv('RATE_LIMITS', 'list=10,subresource=50,media=20,write=10').split(',')) if name.strip() and rate.strip())
+RATE_MIN = float(os.getenv('RATE_MIN', 0.5))
+# response slower than this many times the usual one means the host is overloaded
+RATE_LATENCY_FACTOR = float(os.getenv('RATE_LATENCY_FACTOR', 3))
+# max connections kept alive per host
+EAGLE_POOL_SIZE = int(os.getenv('EAGLE_POOL_SIZE', 10))
+WP_POOL_SIZE = int(os.getenv('WP_POOL_SIZE', 10))
+SITE_DOMAIN = os.getenv('SITE_DOMAIN') or ('http://savoy' if bool( re.match('^.*local.*$', socket.gethostname()) ) else 'https://www.savoy.com.au')
+EAGLE_API = os.getenv('EAGLE_API', 'https://www.eagleagent.com.au/api/v2')
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'
 WP_REST_TOKEN = base64.standard_b64encode( bytes(SITE_LOGIN + ':' + SITE_PASS, encoding='utf-8') )
-HEADERS_AUTH_WP = {'Authorization': 'Basic ' + WP_REST_TOKEN.decode('utf-8'), 'Content-Type': 'application/json', 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'}
-HEADERS_EAGLE_TOKEN_REQUEST = {'Content-Type': 'application/vnd.api+json'}
+HEADERS_AUTH_WP = {'Authorization': 'Basic ' + WP_REST_TOKEN.decode('utf-8'), 'Content-Type': 'application/json', 'User-Agent': USER_AGENT}
+HEADERS_EAGLE = {'Content-Type': 'application/vnd.api+json', 'User-Agent': USER_AGENT}
+# sessions request goes without token
+HEADERS_EAGLE_TOKEN_REQUEST = {'Authorization': None}
+# fields of the property payload which are pushed together
+PAYLOAD_GROUPS = {
+	'content': ['title', 'content', 'status', 'author'],
+	'terms': ['property_type', 'property_feature', 'property_status', 'property_city', 'property_area', 'property_state'],
+	'meta': ['fave_property_price', 'fave_property_land', 'fave_property_size_prefix', 'fave_property_land_postfix', 'fave_property_bedrooms', 'fave_property_bathrooms', 'fave_property_garage', 'fave_property_map', 'houzez_geolocation_lat', 'houzez_geolocation_long', 'fave_property_map_address', 'fave_property_location', 'fave_property_address', 'fave_property_zip', 'fave_property_country', 'fave_agent_display_option', 'fave_agents', 'fave_video_url'],
+	'media': ['_thumbnail_id', '_thumbnail_name', 'crm_image_ids', 'fave_property_images', 'crm_attachment_ids', 'fave_attachments', 'fave_floor_plans_enable', 'floor_plans'],
+	'ofi': ['fw_options']
+}
+MEDIA_FIELDS = ['crm_image_ids', 'fave_property_images', 'crm_attachment_ids', 'fave_attachments']
+# fields of site posts which are kept in the state
+SITE_STATE_FIELDS = ['id', 'crm_id', 'crm_updated', 'property_status', '_thumbnail_id', '_thumbnail_name'] + MEDIA_FIELDS
+PUBLISHED_STATUSES = ['active', 'let', 'under application', 'under offer', 'sold']
 EAGLE_TOKEN_BODY = {
 	'data': {
 		'type': 'sessions',
@@ -58,191 +160,1117 @@ def debug(text, timelog=False):
 		print(text)
 
 
-def getEagleToken():
-	try:
-		tokenResponse = requests.post('https://www.eagleagent.com.au/api/v2/sessions', data=json.dumps(EAGLE_TOKEN_BODY), headers=HEADERS_EAGLE_TOKEN_REQUEST)
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.counters = {}
+		self.histograms = {}
+		# (crm id, seconds) of every synced property
+		self.properties = []
+
+	def count(self, name, labels, value=1):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def observe(self, name, labels, seconds):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			histogram = self.histograms.setdefault(key, {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0, 'count': 0, 'max': 0})
+			for i, bound in enumerate(METRICS_BUCKETS):
+				if seconds <= bound:
+					histogram['buckets'][i] += 1
+			histogram['sum'] += seconds
+			histogram['count'] += 1
+			histogram['max'] = max(histogram['max'], seconds)
+
+	def request(self, endpoint, status, seconds, sent=0, received=0):
+		labels = {'endpoint': endpoint, 'status': str(status)}
+		self.observe('request_duration_seconds', labels, seconds)
+		self.count('requests_total', labels)
+		if sent:
+			self.count('request_bytes_total', {'endpoint': endpoint}, sent)
+		if received:
+			self.count('response_bytes_total', {'endpoint': endpoint}, received)
+
+	def property(self, crmID, seconds):
+		self.observe('property_sync_duration_seconds', {}, seconds)
+		with self.lock:
+			self.properties.append((crmID, seconds))
+
+	@contextmanager
+	def timer(self, stage):
+		start = time.perf_counter()
 		try:
-			response = json.loads(tokenResponse.text)
+			yield
+		finally:
+			self.observe('stage_duration_seconds', {'stage': stage}, time.perf_counter() - start)
+
+	def records(self):
+		with self.lock:
+			for (name, labels), value in sorted(self.counters.items()):
+				yield {'metric': name, 'labels': dict(labels), 'value': value}
+			for (name, labels), histogram in sorted(self.histograms.items()):
+				yield dict(histogram, metric=name, labels=dict(labels), buckets=dict(zip(METRICS_BUCKETS, histogram['buckets'])))
+			for crmID, seconds in self.properties:
+				yield {'metric': 'property_sync_seconds', 'labels': {'crm_id': crmID}, 'value': seconds}
+
+	def writeJSON(self, path):
+		# one line per metric, every run appends its own lines
+		with open(path, 'a') as file:
+			for record in self.records():
+				record['run'] = self.started
+				file.write(json.dumps(record) + '\n')
+
+	def writePrometheus(self, path):
+		def labelText(labels, extra={}):
+			labels = dict(labels, **extra)
+			if not labels:
+				return ''
+			return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+		lines = ['sync_run_timestamp_seconds %f' % self.started]
+		for record in self.records():
+			name = 'sync_' + record['metric']
+			if record['metric'] == 'property_sync_seconds':
+				# per property values are only in JSON, histogram has the same data without ids
+				continue
+			if 'buckets' not in record:
+				lines.append('%s%s %s' % (name, labelText(record['labels']), record['value']))
+				continue
+			for bound, value in record['buckets'].items():
+				lines.append('%s_bucket%s %d' % (name, labelText(record['labels'], {'le': bound}), value))
+			lines.append('%s_bucket%s %d' % (name, labelText(record['labels'], {'le': '+Inf'}), record['count']))
+			lines.append('%s_sum%s %f' % (name, labelText(record['labels']), record['sum']))
+			lines.append('%s_count%s %d' % (name, labelText(record['labels']), record['count']))
+
+		# textfile collector must never see a half written file
+		tmp = path + '.tmp'
+		with open(tmp, 'w') as file:
+			file.write('\n'.join(lines) + '\n')
+		os.replace(tmp, path)
+
+	def export(self):
+		if not METRICS_PATH:
+			return
+
+		if METRICS_FORMAT == 'prometheus':
+			self.writePrometheus(METRICS_PATH)
+		else:
+			self.writeJSON(METRICS_PATH)
+		debug('Metrics were written to %s.' % METRICS_PATH)
 
-			if 'errors' in response:
-				log('Authentication failed. %s' % response['errors'][0]['detail'], 'red')
-				exit(-1)
+		# long running daemon exports many times, write every property once
+		with self.lock:
+			self.properties = []
 
-			if 'data' in response:
-				return response['data']['attributes']['token']
+	def summary(self):
+		with self.lock:
+			stages = [(dict(labels)['stage'], histogram) for (name, labels), histogram in self.histograms.items() if name == 'stage_duration_seconds']
+			requests = sum(value for (name, labels), value in self.counters.items() if name == 'requests_total')
+			retries = sum(value for (name, labels), value in self.counters.items() if name == 'retries_total')
+			limited = sum(value for (name, labels), value in self.counters.items() if name == 'rate_limited_seconds_total')
+			cached = sum(value for (name, labels), value in self.counters.items() if name == 'response_cache_total' and dict(labels)['result'] == 'hit')
 
-		except Exception as e:
-			log('Error while trying to parse JSON. %s' % e, 'red')
-			exit(-1)
+		for stage, histogram in sorted(stages, key=lambda stage: -stage[1]['sum']):
+			debug('%s: %.2fs in %d calls' % (stage, histogram['sum'], histogram['count']))
+		debug('%d requests, %d retries, %d cached responses, %.1fs waited for rate limits' % (requests, retries, cached, limited))
 
-	except ConnectionResetError:
-		time.sleep(60)
-		return getEagleToken()
 
-	except Exception as e:
-		log(e, 'red')
-		exit(-1)
+METRICS = Metrics()
 
 
-def req(method, url, dataType='json', data='', headers={}):
+def timed(stage):
+	# records duration of every call of the function as a stage
+	def decorator(function):
+		def wrapper(*args, **kwargs):
+			with METRICS.timer(stage):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+class Plan:
+	# what sync would do, collected instead of writing to the site
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.actions = []
+
+	def add(self, action, **details):
+		entry = {'action': action, 'crm_id': getattr(JOB, 'crmID', None)}
+		entry.update(details)
+		with self.lock:
+			self.actions.append(entry)
+
+	def counts(self):
+		counts = {}
+		for entry in self.actions:
+			counts[entry['action']] = counts.get(entry['action'], 0) + 1
+
+		return counts
+
+
+# set by plan command
+PLAN = None
+# property synced by the current thread
+JOB = threading.local()
+# id of this run in the journal
+RUN_ID = datetime.now().strftime('%Y%m%d%H%M%S')
+
+
+def endpointName(method, url):
+	# ids are replaced, so all calls of one endpoint are counted together
+	parts = urlsplit(url)
+	path = re.sub(r'/\d+(?=/|$)', '/{id}', parts.path)
+	if url.startswith(SITE_DOMAIN):
+		return '%s wp %s' % (method, path)
+	if EAGLE_TOKEN.covers(url):
+		return '%s eagle %s' % (method, path)
+
+	# attachments, one name per host
+	return '%s media %s' % (method, parts.netloc)
+
+
+def bodyLength(data):
+	if isinstance(data, (bytes, str)):
+		return len(data)
+
+	return getattr(data, 'len', 0)
+
+
+class EagleToken:
+	def __init__(self, path, scope):
+		self.path = path
+		# urls which need the token
+		self.scope = scope
+		self.lock = threading.Lock()
+		self.token = None
+		self.expires = 0
+		self.loaded = False
+
+	def covers(self, url):
+		return url.startswith(self.scope)
+
+	def load(self):
+		# token from the previous run
+		self.loaded = True
+		try:
+			with open(self.path, 'r') as file:
+				cached = json.loads(file.read())
+			self.token = cached['token']
+			self.expires = cached['expires']
+		except (OSError, ValueError, KeyError):
+			pass
+
+	def save(self):
+		# readable by owner only
+		tmp = self.path + '.tmp'
+		fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'w') as file:
+			file.write(json.dumps({'token': self.token, 'expires': self.expires}))
+		os.replace(tmp, self.path)
+
+	def get(self):
+		with self.lock:
+			if not self.loaded:
+				self.load()
+
+			# renew a bit before it expires, so a long run doesn't stall on it
+			if not self.token or time.time() > self.expires - EAGLE_TOKEN_REFRESH_MARGIN:
+				debug('Getting new Eagle token.')
+				self.token, self.expires = getEagleToken()
+				self.save()
+
+			return self.token
+
+	def invalidate(self, token):
+		with self.lock:
+			# other thread could renew it already
+			if token == self.token:
+				self.token = None
+
+
+class TokenBucket:
+	def __init__(self, name, rate):
+		self.name = name
+		self.maxRate = rate
+		self.rate = rate
+		self.tokens = max(1.0, rate)
+		self.updated = time.monotonic()
+		self.pausedUntil = 0
+		self.slowedAt = 0
+		self.latency = None
+		self.baseline = None
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		# returns seconds spent waiting
+		waited = 0
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if now >= self.pausedUntil and self.tokens >= 1:
+					self.tokens -= 1
+					return waited
+				delay = max(self.pausedUntil - now, (1 - self.tokens) / self.rate)
+
+			time.sleep(delay)
+			waited += delay
+
+	def slowDown(self, factor, pause=0):
+		with self.lock:
+			now = time.monotonic()
+			self.pausedUntil = max(self.pausedUntil, now + pause)
+			# one decrease per second, parallel requests report the same trouble
+			if now - self.slowedAt >= 1:
+				self.slowedAt = now
+				self.rate = max(RATE_MIN, self.rate * factor)
+				debug('Rate of %s went down to %.1f/s.' % (self.name, self.rate))
+
+	def feedback(self, status, seconds, response=None, watchLatency=True):
+		if status == 'error' or status == 429 or (isinstance(status, int) and status >= 500):
+			# host asked to wait, other threads wait too
+			pause = retryDelay(0, response) if response is not None and response.headers.get('Retry-After') else 0
+			self.slowDown(0.7, pause)
+			return
+
+		if watchLatency:
+			with self.lock:
+				self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+				self.baseline = self.latency if self.baseline is None else min(self.baseline * 1.01, self.latency)
+				slow = self.latency > self.baseline * RATE_LATENCY_FACTOR
+			if slow:
+				self.slowDown(0.8)
+				return
+
+		with self.lock:
+			# additive increase back to the configured rate
+			self.rate = min(self.maxRate, self.rate + self.maxRate * 0.05)
+
+
+class RateLimiter:
+	def __init__(self, limits):
+		self.limits = limits
+		self.buckets = {}
+		self.lock = threading.Lock()
+
+	def bucket(self, method, url):
+		# None if the class isn't limited
+		endpointClass = getEndpointClass(method, url)
+		if not self.limits.get(endpointClass):
+			return None
+
+		key = (urlsplit(url).netloc, endpointClass)
+		with self.lock:
+			if key not in self.buckets:
+				self.buckets[key] = TokenBucket('%s %s' % key, self.limits[endpointClass])
+
+			return self.buckets[key]
+
+
+LIMITER = RateLimiter(RATE_LIMITS)
+
+
+def getEndpointClass(method, url):
+	path = urlsplit(url).path
+	if method == 'GET':
+		if not url.startswith(SITE_DOMAIN) and not EAGLE_TOKEN.covers(url):
+			# attachment downloads
+			return 'media'
+		if re.search(r'/(properties|agents|property|houzez_agent|snapshot)$', path):
+			return 'list'
+		return 'subresource'
+
+	if path.endswith('/wp/v2/media'):
+		return 'media'
+
+	return 'write'
+
+
+class HTTPClient:
+	def __init__(self, headers, poolSize, maxConcurrency, auth=None):
+		self.auth = auth
+		self.slots = threading.BoundedSemaphore(maxConcurrency)
+		self.session = requests.Session()
+		self.session.headers.update(headers)
+
+		# one pool per host, poolSize connections in every pool
+		self.adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=poolSize)
+		self.session.mount('http://', self.adapter)
+		self.session.mount('https://', self.adapter)
+
+	def send(self, method, url, **kwargs):
+		endpoint = endpointName(method, url)
+		bucket = LIMITER.bucket(method, url)
+		if bucket:
+			waited = bucket.acquire()
+			if waited:
+				METRICS.count('rate_limited_seconds_total', {'bucket': bucket.name}, waited)
+
+		with self.slots:
+			start = time.perf_counter()
+			try:
+				response = self.session.request(method, url, **kwargs)
+			except requests.exceptions.RequestException:
+				METRICS.request(endpoint, 'error', time.perf_counter() - start)
+				if bucket:
+					bucket.feedback('error', time.perf_counter() - start)
+				raise
+
+		# streamed body isn't read yet, so it's the time to headers
+		received = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+		seconds = time.perf_counter() - start
+		METRICS.request(endpoint, response.status_code, seconds, bodyLength(kwargs.get('data')), received)
+		if bucket:
+			# upload time depends on the file size more than on the host
+			bucket.feedback(response.status_code, seconds, response, watchLatency=not isinstance(kwargs.get('data'), StreamBody))
+
+		return response
+
+	def request(self, method, url, **kwargs):
+		headers = kwargs.get('headers') or {}
+		if not self.auth or not self.auth.covers(url) or 'Authorization' in headers:
+			return self.send(method, url, **kwargs)
+
+		token = self.auth.get()
+		kwargs['headers'] = dict(headers, Authorization=token)
+		response = self.send(method, url, **kwargs)
+
+		if response.status_code == 401:
+			# token was revoked or expired earlier than expected. Authenticate again and replay once
+			response.close()
+			self.auth.invalidate(token)
+			kwargs['headers']['Authorization'] = self.auth.get()
+			response = self.send(method, url, **kwargs)
+
+		return response
+
+	def stats(self):
+		opened = 0
+		total = 0
+		pools = self.adapter.poolmanager.pools
+		for key in pools.keys():
+			opened += pools[key].num_connections
+			total += pools[key].num_requests
+
+		return {'opened': opened, 'reused': total - opened, 'requests': total}
+
+
+EAGLE_TOKEN = EagleToken(EAGLE_TOKEN_CACHE, EAGLE_API + '/')
+EAGLE = HTTPClient(HEADERS_EAGLE, EAGLE_POOL_SIZE, EAGLE_MAX_CONCURRENCY, EAGLE_TOKEN)
+WP = HTTPClient(HEADERS_AUTH_WP, WP_POOL_SIZE, WP_MAX_CONCURRENCY)
+
+
+STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS media (
+	url TEXT PRIMARY KEY,
+	etag TEXT,
+	last_modified TEXT,
+	sha256 TEXT,
+	media_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256);
+CREATE INDEX IF NOT EXISTS media_media_id ON media (media_id);
+CREATE TABLE IF NOT EXISTS properties (
+	crm_id TEXT PRIMARY KEY,
+	post_id INTEGER,
+	crm_updated TEXT,
+	crm_status TEXT,
+	property_status TEXT,
+	content_hash TEXT,
+	field_hashes TEXT,
+	thumbnail_id INTEGER,
+	thumbnail_name TEXT,
+	crm_image_ids TEXT,
+	fave_property_images TEXT,
+	crm_attachment_ids TEXT,
+	fave_attachments TEXT,
+	last_outcome TEXT,
+	last_synced REAL
+);
+CREATE INDEX IF NOT EXISTS properties_post_id ON properties (post_id);
+CREATE TABLE IF NOT EXISTS agents (
+	crm_id TEXT PRIMARY KEY,
+	post_id INTEGER,
+	resolved REAL
+);
+CREATE TABLE IF NOT EXISTS journal (
+	crm_id TEXT PRIMARY KEY,
+	run TEXT,
+	crm_updated TEXT,
+	step TEXT,
+	post_id INTEGER,
+	media TEXT,
+	updated REAL
+);
+CREATE TABLE IF NOT EXISTS responses (
+	url TEXT PRIMARY KEY,
+	updated TEXT,
+	body TEXT,
+	size INTEGER,
+	used REAL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT
+);
+'''
+
+# (table, column, type) added to existing databases
+STORE_COLUMNS = [
+	('properties', 'field_hashes', 'TEXT')
+]
+
+
+class Store:
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.RLock()
+		self.connection = None
+
+	def connect(self):
+		# connect on first use, so the file isn't created just by importing the script
+		if self.connection is None:
+			self.connection = sqlite3.connect(self.path, check_same_thread=False)
+			self.connection.row_factory = sqlite3.Row
+			self.connection.executescript(STORE_SCHEMA)
+			self.migrate()
+
+		return self.connection
+
+	def migrate(self):
+		# add columns which appeared after the table was created
+		for table, column, columnType in STORE_COLUMNS:
+			columns = [row['name'] for row in self.connection.execute('PRAGMA table_info(%s)' % table)]
+			if column not in columns:
+				self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, columnType))
+
+	def detach(self):
+		# further writes go to a copy in memory, the file stays as it is
+		with self.lock:
+			memory = sqlite3.connect(':memory:', check_same_thread=False)
+			self.connect().backup(memory)
+			self.connection.close()
+			memory.row_factory = sqlite3.Row
+			self.connection = memory
+
+	def query(self, sql, params=()):
+		with self.lock:
+			return self.connect().execute(sql, params).fetchall()
+
+	def execute(self, sql, params=()):
+		with self.transaction() as connection:
+			connection.execute(sql, params)
+
+	@contextmanager
+	def transaction(self):
+		# commits on success, rolls back on exception
+		with self.lock:
+			connection = self.connect()
+			with connection:
+				yield connection
+
+
+STORE = Store(STATE_DB)
+
+
+def clientFor(url):
+	# attachments are stored on Eagle side, so everything which is not the site goes through Eagle pool
+	return WP if url.startswith(SITE_DOMAIN) else EAGLE
+
+
+class RequestFailed(Exception):
+	pass
+
+
+class RequestMaybeDone(RequestFailed):
+	# creating request failed after it could reach the server. Repeating it could make a duplicate
+	pass
+
+
+def parseJSON(response):
+	return json.loads(response.text)
+
+
+def parseJSONWithHeaders(response):
+	return (json.loads(response.text), response.headers)
+
+
+def parseBinary(response):
+	if response.status_code >= 400:
+		raise ValueError('HTTP %d' % response.status_code)
+
+	return response.content
+
+
+def retryDelay(attempt, response=None):
+	# server knows better how long to wait
+	if response is not None and response.status_code in [429, 503] and response.headers.get('Retry-After'):
+		retryAfter = response.headers['Retry-After']
+		try:
+			return float(retryAfter)
+		except ValueError:
+			try:
+				return max(0, (parsedate_to_datetime(retryAfter) - datetime.now(timezone.utc)).total_seconds())
+			except (TypeError, ValueError):
+				pass
+
+	# exponential backoff with full jitter
+	return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def isNotSent(error):
+	# only failures to connect surely happen before the server got the request
+	if isinstance(error, requests.exceptions.ConnectTimeout):
+		return True
+
+	reason = getattr(error.args[0], 'reason', None) if error.args else None
+	return isinstance(reason, NewConnectionError)
+
+
+def retry(call, label, parse=parseJSON, idempotent=True):
+	# call() makes one attempt and returns the response
+	# not idempotent requests create something, so they are repeated only if the server surely didn't handle them
+	deadline = time.monotonic() + RETRY_DEADLINE
+	attempt = 0
+
+	while True:
+		response = None
+
+		try:
+			response = call()
+
+			if response.status_code in RETRY_STATUSES:
+				error = 'HTTP %d' % response.status_code
+				if not idempotent and response.status_code not in UNHANDLED_STATUSES:
+					raise RequestMaybeDone('%s. %s. Not repeated, it could be done already' % (label, error))
+			else:
+				try:
+					return parse(response)
+
+				except ValueError as e:
+					if 400 <= response.status_code < 500:
+						# client error without proper body. Repeating won't help
+						raise RequestFailed('%s. HTTP %d. %s' % (label, response.status_code, e))
+
+					# Result is not a JSON, because of maintenance mode for example
+					error = 'Couldn\'t parse response. %s' % e
+
+		except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError, ConnectionResetError) as e:
+			if not idempotent and not isNotSent(e):
+				raise RequestMaybeDone('%s. %s. Not repeated, it could be done already' % (label, e))
+			error = e
+
+		except requests.exceptions.RequestException as e:
+			raise RequestFailed('%s. %s' % (label, e))
+
+		attempt += 1
+		delay = retryDelay(attempt, response)
+
+		if attempt >= RETRY_ATTEMPTS or time.monotonic() + delay > deadline:
+			raise RequestFailed('%s failed after %d attempts. %s' % (label, attempt, error))
+
+		METRICS.count('retries_total', {'endpoint': endpointName(*label.split(' ', 1))})
+
+		log('%s. %s. Try again in %.1fs' % (label, error, delay), 'red')
+		time.sleep(delay)
+
+
+def send(client, method, url, parse=parseJSON, idempotent=True, **kwargs):
+	return retry(lambda: client.request(method, url, **kwargs), '%s %s' % (method, url), parse, idempotent)
+
+
+def getEagleToken():
 	try:
-		response = requests.request(method, url, data=data, headers=headers)
+		response = send(EAGLE, 'POST', EAGLE_API + '/sessions', data=json.dumps(EAGLE_TOKEN_BODY), headers=HEADERS_EAGLE_TOKEN_REQUEST)
+	except RequestFailed as e:
+		log('Couldn\'t get Eagle token. %s' % e, 'red')
+		exit(-1)
+
+	if 'errors' in response:
+		log('Authentication failed. %s' % response['errors'][0]['detail'], 'red')
+		exit(-1)
+
+	if 'data' in response:
+		attributes = response['data']['attributes']
+		return (attributes['token'], getTokenExpiry(attributes))
 
+
+def getTokenExpiry(attributes):
+	if attributes.get('expires_in'):
+		return time.time() + float(attributes['expires_in'])
+
+	if attributes.get('expires_at'):
 		try:
-			if dataType == 'json':
-				data = json.loads(response.text)
-			elif dataType == 'binary':
-				data = response.content
-
-			return data
-
-		except Exception as e:
-			log('Couldn\'t parse Response. %s' % e, 'red')
-			# Try again
-			time.sleep(60)
-			return req(method, url, dataType, data, headers)
-	
-	except ConnectionResetError:
-		# Try again
-		time.sleep(60)
-		return req(method, url, dataType, data, headers)
+			return datetime.fromisoformat(attributes['expires_at'].replace('Z', '+00:00')).timestamp()
+		except ValueError:
+			pass
 
-	except requests.exceptions.RequestException as e:
-		log(str(e.response) + ' %s' % url, 'red')
-		# Try again
-		time.sleep(60)
-		return req(method, url, dataType, data, headers)
+	return time.time() + EAGLE_TOKEN_TTL
 
 
-def convertDate(dateStr):
+def req(method, url, dataType='json', data='', headers={}):
+	parse = parseBinary if dataType == 'binary' else parseJSON
+
+	return send(clientFor(url), method, url, parse, data=data, headers=headers)
+
+
+def reqCached(url, updated):
+	# Eagle sub-resources are changed together with the property, so its updated_at tells if the saved response is still valid
+	if not RESPONSE_CACHE_SIZE:
+		return req('GET', url)
+
+	rows = STORE.query('SELECT body FROM responses WHERE url = ? AND updated = ?', (url, updated))
+	if rows:
+		METRICS.count('response_cache_total', {'result': 'hit'})
+		STORE.execute('UPDATE responses SET used = ? WHERE url = ?', (time.time(), url))
+		return json.loads(rows[0]['body'])
+
+	METRICS.count('response_cache_total', {'result': 'miss'})
+	response = req('GET', url)
+	if 'errors' in response:
+		return response
+
+	body = json.dumps(response)
+	with STORE.transaction() as connection:
+		connection.execute('INSERT OR REPLACE INTO responses (url, updated, body, size, used) VALUES (?, ?, ?, ?, ?)', (url, updated, body, len(body), time.time()))
+		# drop least recently used responses over the size limit
+		connection.execute('DELETE FROM responses WHERE url IN (SELECT url FROM (SELECT url, SUM(size) OVER (ORDER BY used DESC) AS total FROM responses) WHERE total > ?)', (RESPONSE_CACHE_SIZE,))
+
+	return response
+
+
+def parseDate(dateStr):
 	# convert 2020-02-01T12:30:00.000+11:00
 	# to      2020-02-01T12:30:00.000+1100
 	s = dateStr[::-1].replace(':', '', 1)[::-1]
 
+	return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+
+def convertDate(dateStr):
 	# 2020/02/01 12:30
-	return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z').strftime('%Y/%m/%d %H:%M')
+	return parseDate(dateStr).strftime('%Y/%m/%d %H:%M')
 
  
-def getSitePropertiesList():
-	page = 1
+def iterPages(fetch, pages, workers):
+	# results in the order of pages. Only a few pages are fetched ahead of the consumer
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		pending = deque()
+		for page in pages:
+			pending.append(executor.submit(fetch, page))
+			if len(pending) >= workers:
+				yield pending.popleft().result()
+
+		while pending:
+			yield pending.popleft().result()
+
+
+def getSitePropertiesPage(page, limit, fields=None):
+	propsData = {
+		'per_page': limit,
+		'page': page
+	}
+	url = SITE_DOMAIN + '/wp-json/wp/v2/property'
+	if fields:
+		url += '?_fields=' + ','.join(fields)
+
+	return reqToWPREST('GET', url, data=json.dumps(propsData), withHeaders=True)
+
+
+def isSitePropertiesPage(response):
+	# False after the last page
+	if isinstance(response, dict):
+		if response.get('code') == 'rest_post_invalid_page_number':
+			# the last page was full
+			return False
+
+		# We've got some error. Partial list would look like removed posts
+		raise RequestFailed('Error while trying to get site properties. %s' % response)
+
+	return True
+
+
+def iterSiteProperties(workers=FETCH_WORKERS, fields=None):
+	# yields posts page by page. fields limits keys of every post
 	limit = 100
+	fetch = lambda page: getSitePropertiesPage(page, limit, fields)[0]
+
+	response, headers = getSitePropertiesPage(1, limit, fields)
+	if not isSitePropertiesPage(response):
+		return
+	yield from response
+	count = 1
+
+	totalPages = int(headers.get('X-WP-TotalPages', 0))
+	if workers > 1 and totalPages > 1:
+		for response in iterPages(fetch, range(2, totalPages + 1), workers):
+			if not isSitePropertiesPage(response):
+				return
+			yield from response
+			count += 1
+
+	# walk page by page if total is unknown or posts were added since the first response
+	while len(response) == limit:
+		count += 1
+		response = fetch(count)
+		if not isSitePropertiesPage(response):
+			return
+		yield from response
+
+
+def parseSnapshot(response):
+	# (posts, etag). posts is None if it wasn't modified
+	if response.status_code == 304:
+		return (None, response.headers.get('ETag'))
+
+	return (json.loads(response.text), response.headers.get('ETag'))
+
+
+def getSiteSnapshot(etag=None):
+	# compact list of all posts from the companion plugin, see wordpress/crm-sync-snapshot.php
+	# returns (posts, etag), posts is None if it wasn't changed since etag. Raises LookupError if the plugin is not available
+	headers = {'If-None-Match': etag} if etag else {}
+	posts, etag = send(WP, 'GET', SITE_DOMAIN + '/wp-json/crm-sync/v1/snapshot', parseSnapshot, headers=headers, timeout=90)
+
+	if isinstance(posts, dict):
+		raise LookupError(posts.get('code') or posts)
+
+	return (posts, etag)
+
+
+@timed('site_list')
+def getSitePropertiesList(workers=FETCH_WORKERS):
+	output = list(iterSiteProperties(workers))
+
+	debug('Received site data: %d items' % len(output))
+	return output
+
+
+def getCRMPropertiesPage(offset, limit, sort=''):
+	url = EAGLE_API + '/properties?page%5Blimit%5D=' + str(limit) + '&page%5Boffset%5D=' + str(offset)
+	if sort:
+		url += '&sort=' + sort
+
+	data = send(EAGLE, 'GET', url)
+
+	if 'data' not in data:
+		raise RequestFailed('Error while trying to get properties. %s' % data)
+
+	return data
+
+
+def getCRMTotal(data, limit):
+	# JSON:API gives the total either in meta or in the link to the last page
+	meta = data.get('meta') or {}
+	for key in ['total', 'total_count', 'record_count', 'count']:
+		if key in meta:
+			return int(meta[key])
+
+	last = (data.get('links') or {}).get('last')
+	if last:
+		match = re.search(r'page(?:%5B|\[)offset(?:%5D|\])=(\d+)', last)
+		if match:
+			return int(match.group(1)) + limit
+
+
+def iterCRMProperties(workers=FETCH_WORKERS, start=0):
+	# yields items page by page, beginning from item number start
+	limit = 60
+	fetch = lambda offset: getCRMPropertiesPage(offset, limit)
+
+	data = fetch(start)
+	yield from data['data']
+	count = 1
+
+	total = getCRMTotal(data, limit)
+	if workers > 1 and total and total > start + limit:
+		for data in iterPages(fetch, range(start + limit, total, limit), workers):
+			yield from data['data']
+			count += 1
+
+	# walk page by page if total is unknown or properties were added since the first response
+	while len(data['data']) == limit:
+		data = fetch(start + limit * count)
+		yield from data['data']
+		count += 1
+
+
+@timed('crm_list')
+def getCRMPropertiesList(workers=FETCH_WORKERS):
+	output = list(iterCRMProperties(workers))
+
+	debug('Received CRM data.')
+	return output
+
+
+@timed('crm_changes')
+def getCRMChangedProperties(since):
+	# properties updated at or after since, newest first
+	# returns None if Eagle ignored the sort order
+	limit = 60
+	offset = 0
 	output = []
+	sinceDate = parseDate(since)
+	previous = None
 
 	while True:
-		propsData = {
-			'per_page': limit,
-			'page': page
-		}
-		response = reqToWPREST('GET', SITE_DOMAIN + '/wp-json/wp/v2/property', data=json.dumps(propsData))
+		data = getCRMPropertiesPage(offset, limit, '-updated_at')
 
-		# If it is not a list
-		if isinstance(response, dict):
-			# We've got some error
-			return output
+		for item in data['data']:
+			updated = parseDate(item['attributes']['updated_at'])
+
+			if previous and updated > previous:
+				log('Eagle list is not sorted by updated_at.', 'red')
+				return
 
-		for item in response:
+			if updated < sinceDate:
+				# the rest is older
+				debug('Received %d changed CRM items.' % len(output))
+				return output
+
+			previous = updated
 			output.append(item)
 
-		if len(response) < limit:
-			debug('Received site data: %d items' % len(output))
+		if len(data['data']) < limit:
+			debug('Received %d changed CRM items.' % len(output))
 			return output
 
-		page += 1
+		offset += limit
 
 
-def getCRMPropertiesList():
-	offset = 0
-	limit = 60
+def parseProperty(response):
+	# None only if Eagle doesn't know the property. Other errors must not look like a removal
+	if response.status_code in [404, 410]:
+		return None
+
+	data = parseJSON(response)
+	if 'data' not in data:
+		raise RequestFailed('Property request failed. HTTP %d. %s' % (response.status_code, data.get('errors', data)))
+
+	return data['data']
+
+
+def getProperty(id):
+	# returns the item or None if it was removed from CRM
+	return send(EAGLE, 'GET', EAGLE_API + '/properties/%s' % id, parseProperty)
+
+
+def reqToWPREST(method, url, data='', headers={}, files={}, withHeaders=False, idempotent=True):
+	parse = parseJSONWithHeaders if withHeaders else parseJSON
+
+	return send(WP, method, url, parse, idempotent, data=data, headers=headers, timeout=90)
+
+
+def batchRoute(item):
+	return re.sub(r'/\d+', '/{id}', urlsplit(item['path']).path)
+
+
+def reqToWPRESTBatch(items):
+	# items are {'method': 'POST', 'path': '/crm-sync/v1/media/1', 'body': {...}, 'fallback': '/wp/v2/media/1'}, all of the same route
+	# fallback is sent alone if the site can't batch the path
+	# returns response body for every item in the same order
 	output = []
 
-	try:
-		while True:
-			response = requests.get('https://www.eagleagent.com.au/api/v2/properties?page%5Blimit%5D=' + str(limit) + '&page%5Boffset%5D=' + str(offset), headers=HEADERS_AUTH_EAGLE)
+	for i in range(0, len(items), WP_BATCH_LIMIT):
+		chunk = items[i:i + WP_BATCH_LIMIT]
 
-			try:
-				data = json.loads(response.text)
+		if batchRoute(chunk[0]) in WP_UNBATCHED:
+			# known already, don't waste a request
+			results = [{'code': 'rest_batch_not_allowed'}] * len(chunk)
+		else:
+			batch = [{key: value for key, value in item.items() if key != 'fallback'} for item in chunk]
+			response = reqToWPREST('POST', SITE_DOMAIN + '/wp-json/batch/v1', data=json.dumps({'requests': batch}))
 
-				for item in data['data']:
-					output.append(item)
+			if 'responses' in response:
+				results = [result['body'] for result in response['responses']]
+			else:
+				# batch framework is not available on the site
+				debug('Batch request failed. %s' % response)
+				results = [{'code': 'rest_batch_not_allowed'}] * len(chunk)
 
-				if len(data['data']) < limit:
-					debug('Received CRM data.')
-					return output
+		for item, result in zip(chunk, results):
+			if isinstance(result, dict) and result.get('code') in ['rest_batch_not_allowed', 'rest_no_route']:
+				# route doesn't support batching or companion plugin is not installed. Send it alone
+				WP_UNBATCHED.add(batchRoute(item))
+				result = reqToWPREST(item['method'], SITE_DOMAIN + '/wp-json' + item.get('fallback', item['path']), data=json.dumps(item.get('body', {})))
 
-			except Exception as e:
-				log('Error while trying to parse JSON. %s' % e, 'red')
-				log(response.text, 'red')
+			output.append(result)
 
-				#
-				# Result is not a JSON, because of maintenance mode for example
-				# do not exit, let't try again
-				#
-				time.sleep(180)
-				return getCRMPropertiesList()
-			
-			offset += 60
+	return output
 
-	except ConnectionResetError:
-		time.sleep(60)
-		return getCRMPropertiesList()
 
-	except Exception as e:
-		log('Error while trying to get properties. %s' % e, 'red')
-		time.sleep(60)
-		return getCRMPropertiesList()
+class StreamBody:
+	# file-like request body, so requests sends Content-Length and reads the file in chunks
+	def __init__(self, file, length):
+		self.file = file
+		self.len = length
 
+	def read(self, size=-1):
+		return self.file.read(size)
 
-def getProperty(id):
-	response = requests.get('https://www.eagleagent.com.au/api/v2/properties/%s' % id, headers=HEADERS_AUTH_EAGLE)
-	return json.loads(response.text)	
+
+def getCachedMedia(url):
+	rows = STORE.query('SELECT * FROM media WHERE url = ?', (url,))
+	return rows[0] if rows else None
 
 
-def reqToWPREST(method, url, data='', headers={}, files={}):
-	if not headers:
-		headers=HEADERS_AUTH_WP
+def getMediaByHash(sha256):
+	rows = STORE.query('SELECT * FROM media WHERE sha256 = ? LIMIT 1', (sha256,))
+	return rows[0] if rows else None
 
+
+def cacheMedia(url, headers, sha256, mediaID):
+	STORE.execute('INSERT OR REPLACE INTO media (url, etag, last_modified, sha256, media_id) VALUES (?, ?, ?, ?, ?)', (url, headers.get('ETag'), headers.get('Last-Modified'), sha256, mediaID))
+
+
+def forgetMedia(mediaID):
+	STORE.execute('DELETE FROM media WHERE media_id = ?', (mediaID,))
+
+
+def isMediaShared(mediaID, field, keptIDs=()):
+	# the same file can come from several urls and properties, e.g. primary image is also in the gallery or two listings have one document
+	# media is used if another post, another field of this post or a running job refers to it
+	if str(mediaID) in [str(id) for id in keptIDs]:
+		return True
+
+	crmID = getattr(JOB, 'crmID', None)
+	mediaID = int(mediaID)
+	listed = 'EXISTS (SELECT 1 FROM json_each(%s) WHERE CAST(value AS INTEGER) = :media)'
+	otherFields = [key for key in ['fave_property_images', 'fave_attachments'] if key != field]
+	sql = '''
+		SELECT 1 FROM properties WHERE crm_id IS NOT :crm AND (thumbnail_id = :media OR %s OR %s)
+		UNION ALL SELECT 1 FROM properties WHERE crm_id IS :crm AND (thumbnail_id = :media OR %s)
+		UNION ALL SELECT 1 FROM journal, json_each(journal.media) WHERE CAST(json_each.value AS INTEGER) = :media
+		LIMIT 1
+	''' % (listed % 'fave_property_images', listed % 'fave_attachments', ' OR '.join(listed % key for key in otherFields))
+
+	return len(STORE.query(sql, {'crm': crmID, 'media': mediaID})) > 0
+
+
+def mediaExists(mediaID):
+	response = reqToWPREST('GET', SITE_DOMAIN + '/wp-json/wp/v2/media/%s?_fields=id' % mediaID)
+	return 'id' in response
+
+
+def spoolAttachment(response):
+	# returns (file with the body, sha256 of the body, response headers)
+	# file is None if it wasn't modified since it was cached
 	try:
-		req = requests.request(method, url, data=data, headers=headers, timeout=90)
-		responseCode = req.status_code
-		response = req.text
+		if response.status_code == 304:
+			return (None, None, response.headers)
 
-	except ConnectionResetError:
-		time.sleep(60)
-		return reqToWPREST(method, url, data, headers)
+		if response.status_code >= 400:
+			raise ValueError('HTTP %d' % response.status_code)
 
-	except Exception as e:
-		log('Exception in request. ' + str(e) + ' %s' % url, 'red')
-		responseCode = False
-	
-	if responseCode:
-		try:
-			result = json.loads(response)
+		# small files stay in memory, big ones go to a temporary file
+		body = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+		sha256 = hashlib.sha256()
+		for chunk in response.iter_content(ATTACHMENT_CHUNK_SIZE):
+			sha256.update(chunk)
+			body.write(chunk)
 
-			return result
+		return (body, sha256.hexdigest(), response.headers)
 
-		except Exception as e:
-			log('%s. %s. %s. %s' % (url, responseCode, data, response), 'red')
-			# Try again
-			time.sleep(60)
-			return reqToWPREST(method, url, data, headers)
+	finally:
+		response.close()
 
-	else:
-		# Try again
-		return reqToWPREST(method, url, data, headers)
 
+def uploadAttachment(body, headers):
+	length = body.seek(0, os.SEEK_END)
+	body.seek(0)
+
+	return WP.request('POST', SITE_DOMAIN + '/wp-json/wp/v2/media', data=StreamBody(body, length), headers=headers, timeout=90)
 
+
+@timed('attachment')
 def reqToWPRESTAttachment(url, attachType):
-	attach = req('GET', url, dataType='binary')
+	# uploaded by the interrupted run
+	mediaID = getJournalMedia(url)
+	if mediaID:
+		debug('Attachment %s was uploaded before. Using id=%s.' % (url, mediaID))
+		return mediaID
+
+	mediaID = fetchAttachment(url, attachType)
+	if mediaID and PLAN is None:
+		journalMedia(url, mediaID)
+
+	return mediaID
+
+
+def fetchAttachment(url, attachType):
+	cached = getCachedMedia(url)
+
+	if PLAN is not None:
+		if cached:
+			# most likely not modified
+			return cached['media_id']
+		PLAN.add('upload_media', url=url, type=attachType)
+		return 'planned:%s' % url
+
+	conditional = {}
+	if cached and cached['etag']:
+		conditional['If-None-Match'] = cached['etag']
+	if cached and cached['last_modified']:
+		conditional['If-Modified-Since'] = cached['last_modified']
+
+	try:
+		body, sha256, downloadHeaders = send(clientFor(url), 'GET', url, spoolAttachment, stream=True, headers=conditional)
+	except RequestFailed as e:
+		log('Couldn\'t download attachment. %s' % e, 'red')
+		return
+
+	if body is None:
+		if mediaExists(cached['media_id']):
+			debug('Attachment %s wasn\'t changed. Using id=%s.' % (url, cached['media_id']))
+			return cached['media_id']
+
+		# it was removed on the site. Download it again
+		forgetMedia(cached['media_id'])
+		return fetchAttachment(url, attachType)
 
-	attachName = os.path.basename(url)
-	attachExtention = os.path.splitext(url)[1][1:]
-	headers = {'Authorization': 'Basic ' + WP_REST_TOKEN.decode('utf-8'), 'Content-Type': '%s/%s' % (attachType, attachExtention), 'Content-Disposition': 'attachment; filename=%s' % attachName, 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'}
-	response = reqToWPREST('POST', SITE_DOMAIN +  '/wp-json/wp/v2/media', data=attach, headers=headers)
+	with body:
+		same = getMediaByHash(sha256)
+		if same:
+			if mediaExists(same['media_id']):
+				debug('Attachment %s is already on the site. Using id=%s.' % (url, same['media_id']))
+				cacheMedia(url, downloadHeaders, sha256, same['media_id'])
+				return same['media_id']
+
+			forgetMedia(same['media_id'])
+
+		attachName = os.path.basename(url)
+		attachExtention = os.path.splitext(url)[1][1:]
+		headers = {'Content-Type': '%s/%s' % (attachType, attachExtention), 'Content-Disposition': 'attachment; filename=%s' % attachName}
+
+		try:
+			response = retry(lambda: uploadAttachment(body, headers), 'POST %s/wp-json/wp/v2/media' % SITE_DOMAIN, idempotent=False)
+		except RequestFailed as e:
+			log('Couldn\'t upload attachment. %s' % e, 'red')
+			return
 
 	if 'id' in response:
+		cacheMedia(url, downloadHeaders, sha256, response['id'])
 		return response['id']
 
 
+def transferAttachments(items, attachType):
+	# uploaded ids are returned in the order of items, None if upload failed
+	crmID = getattr(JOB, 'crmID', None)
+
+	def transfer(item):
+		# workers do the same job
+		JOB.crmID = crmID
+		return reqToWPRESTAttachment(item['attributes']['url'], attachType)
+
+	with ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as executor:
+		return list(executor.map(transfer, items))
+
+
 def normalizeTitle(string):
 	return string.replace(' ', '').replace(',', '').lower()
 
@@ -266,63 +1294,125 @@ def normalizePropertyDesc(text):
 	return text
 
 
+def isSameDescription(sdesc, cdesc):
+	if len(sdesc) < len(cdesc):
+		min = sdesc
+		max = cdesc
+	else:
+		min = cdesc
+		max = sdesc
+
+	if min in max:
+		return True
+
+	# text was edited on one side
+	return difflib.SequenceMatcher(None, min, max).ratio() >= AUDIT_SIMILARITY
+
+
 def checkProperties():
 	# Sale statuses: active, under offer, sold
 	# Rent statuses: active, let, under application
 
+	start = time.perf_counter()
 	site = getSitePropertiesList()
 	crm = getCRMPropertiesList()
 
 	log('got %d entries from Eagle' % len(crm), 'yellow')
 	log('got %d entries from WordPress' % len(site), 'yellow')
+	log('Fetched in %.2fs' % (time.perf_counter() - start), 'white')
 	start = time.perf_counter()
 
 	# G09/1 Queen Street, Blackburn, VIC, 3130				 # site
 	# G09 / 1 Queen Street, Blackburn					 # crm
 
-	i = 0
-	obj = {}
-	for k, citem in enumerate(crm):
-		for j, sitem in enumerate(site):
-			stitle = normalizeTitle(sitem['title']['rendered'])
-			ctitle = normalizeTitle(citem['attributes']['full_address'])
-			ctitlefull = normalizeTitle('%s %s %s' % (citem['attributes']['full_address'], citem['attributes']['state'], citem['attributes']['postcode']))
-			sdesc = normalizePostContent( sitem['content']['rendered'] )
-			cdesc = normalizePropertyDesc( citem['attributes']['description'] )
-
-			if stitle == ctitlefull or stitle == ctitle:
-
-				if len(sdesc) < len(cdesc):
-					min = sdesc
-					max = cdesc
-				else:
-					min = cdesc
-					max = sdesc
-				pattern = re.compile('^.*' + min + '.*$', re.DOTALL)
-
-				if bool( re.match(pattern, max) ):
-					if sitem['id'] in d:
-						del obj[sitem['id']]
-					i += 1
-					break
-				else:
-					obj.update( {sitem['id']: sitem} )
-				
-			else:
-				pass
+	# normalize every CRM item once and index it by both forms of address
+	crmIndex = {}
+	for citem in crm:
+		cdesc = normalizePropertyDesc( citem['attributes']['description'] )
+		ctitle = normalizeTitle(citem['attributes']['full_address'])
+		ctitlefull = normalizeTitle('%s %s %s' % (citem['attributes']['full_address'], citem['attributes']['state'], citem['attributes']['postcode']))
 
-	log(i, 'magenta')
-	log(time.perf_counter() - start, 'white')
-	log(json.dumps(obj))
+		for key in set([ctitle, ctitlefull]):
+			crmIndex.setdefault(key, []).append(cdesc)
 
+	log('Eagle entries indexed in %.2fs' % (time.perf_counter() - start), 'white')
+	start = time.perf_counter()
 
-def submitProperty(property, post=None, update=False):
+	matched = 0
+	# same address, different description
+	mismatched = {}
+	# address is not in CRM
+	orphans = {}
+	siteTitles = {}
 
-	if update:
-		# remove terms
-		reqToWPREST('DELETE', SITE_DOMAIN + '/wp-json/wp/v2/property-terms/%d' % post['id'])
+	for sitem in site:
+		stitle = normalizeTitle(sitem['title']['rendered'])
+		siteTitles.setdefault(stitle, []).append(sitem['id'])
+
+		if stitle not in crmIndex:
+			orphans[sitem['id']] = sitem['title']['rendered']
+			continue
+
+		sdesc = normalizePostContent( sitem['content']['rendered'] )
+
+		if any(isSameDescription(sdesc, cdesc) for cdesc in crmIndex[stitle]):
+			matched += 1
+		else:
+			mismatched[sitem['id']] = sitem['title']['rendered']
+
+	# several posts with the same address
+	duplicates = {title: ids for title, ids in siteTitles.items() if len(ids) > 1}
+
+	log('WordPress entries compared in %.2fs' % (time.perf_counter() - start), 'white')
+	log('%d matched, %d with different description, %d not in CRM, %d duplicated addresses' % (matched, len(mismatched), len(orphans), len(duplicates)), 'magenta')
+	log(json.dumps({'mismatched': mismatched, 'orphans': orphans, 'duplicates': duplicates}))
+
+
+@timed('property_resources')
+def fetchPropertyResources(property):
+	# sub-resources don't depend on each other, so get them at once
+	links = property['relationships']
+	urls = {
+		'images': links['images']['links']['related'] + '?sort=position',
+		'documents': links['documents']['links']['related'],
+		'inspections': links['inspections']['links']['related'],
+		'floorplans': links['floorplans']['links']['related']
+	}
+
+	with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+		futures = {name: executor.submit(reqCached, url, property['attributes']['updated_at']) for name, url in urls.items()}
+
+	return {name: future.result() for name, future in futures.items()}
+
+
+def getOFI(ofiResponse):
+	if 'data' in ofiResponse and len(ofiResponse['data']):
+		# get actual(last) OFI
+		start = ofiResponse['data'][len(ofiResponse['data']) - 1]['attributes']['start_datetime']
+		end = ofiResponse['data'][len(ofiResponse['data']) - 1]['attributes']['end_datetime']
+
+		return {
+			'property_ofi': {
+				'from': convertDate(start),
+				'to': convertDate(end)
+			}
+		}
+
+	return ''
+
+
+def hashPayload(data):
+	return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
 
+
+def hashGroups(data):
+	return {group: hashPayload({key: data[key] for key in keys}) for group, keys in PAYLOAD_GROUPS.items()}
+
+
+def submitProperty(property, post=None, update=False):
 	prop = property['attributes']
+	journalStep(property['id'], 'started', crm_updated=prop['updated_at'])
+	resources = fetchPropertyResources(property)
 
 	# media: featured
 	if update:
@@ -356,34 +1446,22 @@ def submitProperty(property, post=None, update=False):
 	# property attachments: images
 	crmImageIDsList = post['crm_image_ids'] if update else []
 	siteImageIDsList = post['fave_property_images'] if update else []
-	imageIDs = uploadAttachments(property['relationships']['images']['links']['related'] + '?sort=position', update, crmImageIDsList, siteImageIDsList, 'image')
+	imageIDs = uploadAttachments(property['relationships']['images']['links']['related'] + '?sort=position', update, crmImageIDsList, siteImageIDsList, 'image', resources['images'])
 
 	# property attachments: documents
 	crmAttachIDsList = post['crm_attachment_ids'] if update else []
 	siteAttachIDsList = post['fave_attachments'] if update else []
-	attachIDs = uploadAttachments(property['relationships']['documents']['links']['related'], update, crmAttachIDsList, siteAttachIDsList, 'application')
+	attachIDs = uploadAttachments(property['relationships']['documents']['links']['related'], update, crmAttachIDsList, siteAttachIDsList, 'application', resources['documents'])
 
 	# OFI
-	dateOFI = ''
-	ofiResponse = req('GET', property['relationships']['inspections']['links']['related'], headers=HEADERS_AUTH_EAGLE)
-	if 'data' in ofiResponse and len(ofiResponse['data']):
-		# get actual(last) OFI
-		start = ofiResponse['data'][len(ofiResponse['data']) - 1]['attributes']['start_datetime']
-		end = ofiResponse['data'][len(ofiResponse['data']) - 1]['attributes']['end_datetime']
-
-		dateOFI = {
-			'property_ofi': {
-				'from': convertDate(start),
-				'to': convertDate(end)
-			}
-		}
+	dateOFI = getOFI(resources['inspections'])
 
 	# content
 	title = '%s, %s, %s' % (prop['full_address'], prop['state'], prop['postcode'])
 	content = '<p><strong>%s</strong></p>\n%s' % (prop['headline'], prop['description'])
 
 	# floor plans
-	floorPlansResponse = req('GET', property['relationships']['floorplans']['links']['related'], headers=HEADERS_AUTH_EAGLE)
+	floorPlansResponse = resources['floorplans']
 	if 'data' in floorPlansResponse and len(floorPlansResponse['data']):
 		floorPlan = []
 		for plan in floorPlansResponse['data']:
@@ -444,10 +1522,8 @@ def submitProperty(property, post=None, update=False):
 	}
 
 	# agents
-	# get last id in agents array
-	#agent = getAgentByCRMID( [ prop['agent_ids'][len(prop['agent_ids']) - 1] ] )
-	# use firts agent
-	agent = getAgentByCRMID( [ prop['agent_ids'][0] ] )
+	# use first agent which is on the site
+	agent = getAgentByCRMID(prop['agent_ids'])
 
 	# price
 	price = prop['alt_to_price'] if prop['alt_to_price'] else prop['price'] if prop['price'] and prop['price'] != '0.0' else prop['advertised_price']
@@ -516,82 +1592,209 @@ def submitProperty(property, post=None, update=False):
 		# 'additional_features': [],
 	}
 
+	fieldHashes = hashGroups(data)
+	state = postState(data)
+	state.update(crm_updated=prop['updated_at'], crm_status=prop['status'], content_hash=hashPayload(data), field_hashes=json.dumps(fieldHashes))
+
 	if update:
-		response = reqToWPREST('POST', SITE_DOMAIN + '/wp-json/wp/v2/property/%s' % post['id'], data=json.dumps(data))
+		# send only groups of fields which were changed since the last push
+		changedGroups = [group for group in PAYLOAD_GROUPS if fieldHashes[group] != post['field_hashes'].get(group)]
+
+		if not changedGroups:
+			debug('Property id=%s has no changes for the site.' % property['id'])
+			updateState(property['id'], last_outcome='unchanged', **state)
+			finishJob(property['id'])
+			return
+
+		debug('Property id=%s changed: %s.' % (property['id'], ', '.join(changedGroups)))
+
+		changedData = {'crm_id': data['crm_id'], 'crm_updated': data['crm_updated']}
+		for group in changedGroups:
+			for key in PAYLOAD_GROUPS[group]:
+				changedData[key] = data[key]
 	else:
-		response = reqToWPREST('POST', SITE_DOMAIN + '/wp-json/wp/v2/property', data=json.dumps(data))
+		changedGroups = list(PAYLOAD_GROUPS)
+		changedData = data
+
+	if PLAN is not None:
+		if update:
+			# only hashes of groups are kept, so all fields of a changed group are listed
+			PLAN.add('update', post=post['id'], groups=changedGroups, group_fields=[key for group in changedGroups for key in PAYLOAD_GROUPS[group]])
+		else:
+			PLAN.add('create', title=title, status=status)
+		return
+
+	if update:
+		if 'terms' in changedGroups:
+			# remove terms
+			reqToWPREST('DELETE', SITE_DOMAIN + '/wp-json/wp/v2/property-terms/%d' % post['id'])
+
+		response = reqToWPREST('POST', SITE_DOMAIN + '/wp-json/wp/v2/property/%s' % post['id'], data=json.dumps(changedData))
+	else:
+		response = reqToWPREST('POST', SITE_DOMAIN + '/wp-json/wp/v2/property', data=json.dumps(data), idempotent=False)
 
 	if 'id' in response:
 		log('Property id=%s was %s. URL=%s' % (property['id'], 'updated' if update else 'added', response['link']), 'yellow')
 
-		# attach attachments to post
-		dataAttach = {
-			'post_parent': response['id']
-		}
-		attachList = imageIDs[1] + attachIDs[1] + [featuredID] if featuredID else imageIDs[1] + attachIDs[1]
-		for attachID in attachList:
-			reqToWPREST('POST', SITE_DOMAIN + '/wp-json/wp/v2/media/%s' % attachID, data=json.dumps(dataAttach))
+		updateState(property['id'], post_id=response['id'], last_outcome='updated' if update else 'added', **state)
+		journalStep(property['id'], 'post_written', post_id=response['id'])
+
+		if 'media' in changedGroups:
+			attachMedia(response['id'], imageIDs[1] + attachIDs[1] + [featuredID] if featuredID else imageIDs[1] + attachIDs[1])
+
+		finishJob(property['id'])
 
 	else:
 		log('Property wasn\'t %s. %s' % ('updated' if update else 'added', response), 'red')
 		exit(-1)
 
 
-def getPostByCRMID(crmID, posts):
-	for post in posts:
-		if post['crm_id'] == crmID:
-			return post
-
-
-def getAgentByCRMID(id):
-
-	agents = {
-		'816': 6378,
-		'10326': 6994,
-		'3603': 2948,
-		'4911': 3393,
-		'10228': 7061,
-		'2345': 158,
-		'3130': 72,
-		'2415': 150,
-		'2398': 2018,
-		'12117': 8381,
-		'11816': 8314
+def attachMedia(postID, attachList):
+	# attach attachments to post
+	dataAttach = {
+		'post_parent': postID
 	}
-        
-	# search in cached data firstly
-	for agent in id:
-		if agent in agents:
-			# return wordpress agent ID
-			return agents[agent]
-		else:
-			# new agent was added to CRM. Try to find him on the site
-			crmAgents = req('GET', 'https://www.eagleagent.com.au/api/v2/agents', headers=HEADERS_AUTH_EAGLE)
-			siteAgents = reqToWPREST('GET', SITE_DOMAIN + '/wp-json/wp/v2/houzez_agent/')
-
-			if 'data' in crmAgents:
-				for cperson in crmAgents['data']:
-					if cperson['id'] == agent:
-
-						for i, sperson in enumerate(siteAgents):
-							if cperson['attributes']['name'] == sperson['title']['rendered']:
-								return sperson['id']
-							else:
-								if len(siteAgents) - 1 == i:
-									log('Agent %s was not found on the site.' % cperson['attributes']['name'], 'red')
-									exit(-1)
+	# core media routes can't be batched, the companion plugin has ones which can
+	results = reqToWPRESTBatch([{'method': 'POST', 'path': '/crm-sync/v1/media/%s' % attachID, 'body': dataAttach, 'fallback': '/wp/v2/media/%s' % attachID} for attachID in attachList])
+	for attachID, result in zip(attachList, results):
+		if not 'id' in result:
+			log('Attachment id=%s wasn\'t attached to post. %s' % (attachID, result), 'red')
 
-					else:
-						continue
-			else:
-				log('Couldn\'t get proper response. %s' % crmAgents, 'red')
 
+def getCRMAgentsList():
+	offset = 0
+	limit = 60
+	output = []
+
+	while True:
+		data = send(EAGLE, 'GET', EAGLE_API + '/agents?page%5Blimit%5D=' + str(limit) + '&page%5Boffset%5D=' + str(offset))
 
-def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
+		if 'data' not in data:
+			raise RequestFailed('Error while trying to get agents. %s' % data)
+
+		output.extend(data['data'])
+
+		if len(data['data']) < limit:
+			return output
+
+		offset += limit
+
+
+def getSiteAgentsList():
+	page = 1
+	limit = 100
+	output = []
+
+	while True:
+		response, headers = reqToWPREST('GET', SITE_DOMAIN + '/wp-json/wp/v2/houzez_agent?per_page=%d&page=%d' % (limit, page), withHeaders=True)
+
+		if isinstance(response, dict):
+			raise RequestFailed('Error while trying to get site agents. %s' % response)
+
+		output.extend(response)
+
+		if page >= int(headers.get('X-WP-TotalPages', page)) or len(response) < limit:
+			return output
+
+		page += 1
+
+
+def normalizeName(name):
+	return html.unescape(name).strip().lower()
+
+
+class AgentResolver:
+	def __init__(self, agents):
+		# agents linked by hand
+		self.agents = dict(agents)
+		self.lock = threading.Lock()
+		self.loaded = False
+		self.directory = None
+		self.directoryLoaded = 0
+
+	def load(self):
+		# mappings resolved by previous runs
+		rows = STORE.query('SELECT crm_id, post_id FROM agents WHERE resolved > ?', (time.time() - AGENT_TTL,))
+		for row in rows:
+			self.agents.setdefault(row['crm_id'], row['post_id'])
+		self.loaded = True
+
+	def loadDirectory(self):
+		# both directories: {crm agent id: (name, site agent id)}
+		siteAgents = {}
+		for sperson in getSiteAgentsList():
+			siteAgents[normalizeName(sperson['title']['rendered'])] = sperson['id']
+
+		self.directory = {}
+		for cperson in getCRMAgentsList():
+			name = cperson['attributes']['name']
+			self.directory[cperson['id']] = (name, siteAgents.get(normalizeName(name)))
+
+		self.directoryLoaded = time.monotonic()
+		debug('Loaded %d CRM agents and %d site agents.' % (len(self.directory), len(siteAgents)))
+
+	def resolve(self, ids):
+		with self.lock:
+			if not self.loaded:
+				self.load()
+
+			for agent in ids:
+				# search in cached data firstly
+				if agent in self.agents:
+					# return wordpress agent ID
+					return self.agents[agent]
+
+				# new agent was added to CRM. Try to find him on the site
+				if self.directory is None:
+					self.loadDirectory()
+
+				name, siteID = self.directory.get(agent, (agent, None))
+				if not siteID and time.monotonic() - self.directoryLoaded >= AGENT_DIRECTORY_TTL:
+					# the agent could be added after the lists were loaded, e.g. while the daemon runs
+					self.loadDirectory()
+					name, siteID = self.directory.get(agent, (agent, None))
+
+				if siteID:
+					self.agents[agent] = siteID
+					STORE.execute('INSERT OR REPLACE INTO agents (crm_id, post_id, resolved) VALUES (?, ?, ?)', (agent, siteID, time.time()))
+					return siteID
+
+				log('Agent %s was not found on the site.' % name, 'red')
+
+
+AGENTS = AgentResolver({
+	'816': 6378,
+	'10326': 6994,
+	'3603': 2948,
+	'4911': 3393,
+	'10228': 7061,
+	'2345': 158,
+	'3130': 72,
+	'2415': 150,
+	'2398': 2018,
+	'12117': 8381,
+	'11816': 8314
+})
+
+
+def getAgentByCRMID(ids):
+	if not ids:
+		return ''
+
+	agent = AGENTS.resolve(ids)
+	if not agent:
+		exit(-1)
+
+	return agent
+
+
+@timed('attachments')
+def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType, response=None):
 	crmAttachIDs = []
 	siteAttachIDs = []
 
-	response = req('GET', url, headers=HEADERS_AUTH_EAGLE)
+	if response is None:
+		response = req('GET', url)
 	
 	if not 'errors' in response:
 		if update:
@@ -601,14 +1804,17 @@ def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
 				for item in response['data']:
 					crmActualIDs.append(item['id'])
 
+				# upload new attachments at once, keeping their order
+				newItems = [item for item in response['data'] if item['id'] not in crmSavedIDs]
+				debug('Adding %d new attachments to post...' % len(newItems))
+				uploaded = dict(zip([item['id'] for item in newItems], transferAttachments(newItems, attachType)))
+
 				for item in response['data']:
 					if item['id'] in crmSavedIDs:
 						crmAttachIDs.append(item['id'])
 						siteAttachIDs.append( siteSavedIDs[ crmSavedIDs.index(item['id']) ] )
 					else:
-						# upload attach
-						debug('Adding new attachment to post...')
-						uploadedID = reqToWPRESTAttachment(item['attributes']['url'], attachType)
+						uploadedID = uploaded[item['id']]
 						if uploadedID:
 							crmAttachIDs.append(item['id'])
 							siteAttachIDs.append(uploadedID)
@@ -616,6 +1822,7 @@ def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
 						else:
 							log('Couldn\'t upload attachment.', 'red')
 						
+				removed = []
 				for i, sid in enumerate(crmSavedIDs):
 					# attach was removed in crm
 					if sid not in crmActualIDs:
@@ -625,20 +1832,28 @@ def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
 						# fave_property_images/fave_attachments and crm_image_ids/crm_attachment_ids should be unset
 						# but it doesn't make much sense in real cases
 
-						# remove attachment itself
-						rdata = {
-							'force': True
-						}
-						reqRemove = reqToWPREST('DELETE', SITE_DOMAIN + '/wp-json/wp/v2/media/%s' % siteSavedIDs[i], data=json.dumps(rdata))
-						if 'deleted' in reqRemove:
-							debug('Attachment id=%s was removed.' % siteSavedIDs[i])
-						else:
-							# append attach again to try remove later
-							crmAttachIDs.append(sid)
-							# i is the index of item in siteSavedIDs list
-							siteAttachIDs.append(siteSavedIDs[i])
+						if isMediaShared(siteSavedIDs[i], 'fave_property_images' if attachType == 'image' else 'fave_attachments', siteAttachIDs):
+							debug('Attachment id=%s is still used. Not removed.' % siteSavedIDs[i])
+							continue
+
+						# i is the index of item in siteSavedIDs list
+						removed.append(i)
+
+				# remove attachments themselves
+				if PLAN is not None:
+					for i in removed:
+						PLAN.add('delete_media', media=siteSavedIDs[i], crm_media=crmSavedIDs[i])
+					results = [{'deleted': True}] * len(removed)
+				else:
+					results = reqToWPRESTBatch([{'method': 'DELETE', 'path': '/crm-sync/v1/media/%s' % siteSavedIDs[i], 'fallback': '/wp/v2/media/%s?force=true' % siteSavedIDs[i]} for i in removed])
+				for i, reqRemove in zip(removed, results):
+					if 'deleted' in reqRemove:
+						forgetMedia(siteSavedIDs[i])
+						debug('Attachment id=%s was removed.' % siteSavedIDs[i])
 					else:
-						pass
+						# append attach again to try remove later
+						crmAttachIDs.append(crmSavedIDs[i])
+						siteAttachIDs.append(siteSavedIDs[i])
 
 			else:
 				debug('No data received from %s' % url)
@@ -646,9 +1861,8 @@ def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
 		else:
 			# set initially
 			if 'data' in response:
-				for item in response['data']:
-					debug('Posting new attachment initially...')
-					attachID = reqToWPRESTAttachment(item['attributes']['url'], attachType)
+				debug('Posting %d new attachments initially...' % len(response['data']))
+				for item, attachID in zip(response['data'], transferAttachments(response['data'], attachType)):
 					if attachID:
 						siteAttachIDs.append(attachID)
 						crmAttachIDs.append(item['id'])
@@ -662,6 +1876,27 @@ def uploadAttachments(url, update, crmSavedIDs, siteSavedIDs, attachType):
 	return (crmAttachIDs, siteAttachIDs)
 
 
+def trashProperty(post, newStatus):
+	if PLAN is not None:
+		PLAN.add('trash', crm_id=post.get('crm_id'), post=post['id'], status=newStatus)
+		return True
+
+	rdata = {
+		'force': False
+	}
+	req = reqToWPREST('DELETE', SITE_DOMAIN + '/wp-json/wp/v2/property/%d' % post['id'], data=json.dumps(rdata))
+	# actual condition for 'force': False
+	if 'status' in req and req['status'] == 'trash':
+		log('Property id=%s was deleted. Status %s -> %s' % (post['id'], post['property_status'], newStatus), 'cyan')
+		if post.get('crm_id'):
+			# unfinished job of the post doesn't matter anymore
+			finishJob(post['crm_id'])
+		return True
+	else:
+		log('Property wasn\'t deleted. %s. Status %s -> %s' % (req, post['property_status'], newStatus), 'red')
+		return False
+
+
 def checkPropertyChanges(post, property):
 	prop = property['attributes']
 	propStatus = prop['status'].lower()
@@ -671,68 +1906,778 @@ def checkPropertyChanges(post, property):
 		debug('Property id=%s wasn\'t changed. Nothing to update.' % property['id'])
 		return
 
-	if propStatus in ['active', 'let', 'under application', 'under offer', 'sold']:
+	if propStatus in PUBLISHED_STATUSES:
 		# update property post
 		submitProperty(property, post, True)
 
 	else:
 		# remove property post
-		rdata = {
-			'force': False
-		}
-		req = reqToWPREST('DELETE', SITE_DOMAIN + '/wp-json/wp/v2/property/%d' % post['id'], data=json.dumps(rdata))
-		# actual condition for 'force': False
-		if 'status' in req and req['status'] == 'trash':
-			log('Property id=%s was deleted. Status %s -> %s' % (post['id'], post['property_status'], prop['status']), 'cyan')
-		else:
-			log('Property wasn\'t deleted. %s. Status %s -> %s' % (req, post['property_status'], prop['status']), 'red')
+		if trashProperty(post, prop['status']):
+			updateState(property['id'], post_id=None, crm_updated=prop['updated_at'], crm_status=prop['status'], last_outcome='trashed')
+
+
+def diffProperties(old, new, updated):
+	# old is state {crm id: post}, new are CRM items, which can come from a generator
+	# yields added and changed items. updated gets {crm id: updated_at} of every item
+	for item in new:
+		id = item['id']
+		if id in updated:
+			# the same item on the next page, because a page was shifted
+			continue
+
+		updated[id] = item['attributes']['updated_at']
+		if id not in old or updated[id] != old[id]['crm_updated']:
+			yield item
+
+
+def rowToPost(row):
+	# the same keys as in the site response
+	post = {
+		'id': row['post_id'],
+		'crm_id': row['crm_id'],
+		'crm_updated': row['crm_updated'],
+		'crm_status': row['crm_status'],
+		'property_status': json.loads(row['property_status'] or '[]'),
+		'_thumbnail_id': row['thumbnail_id'] or '',
+		'_thumbnail_name': row['thumbnail_name'],
+		'field_hashes': json.loads(row['field_hashes'] or '{}')
+	}
+	for key in MEDIA_FIELDS:
+		post[key] = json.loads(row[key] or '[]')
+
+	return post
+
+
+def loadState():
+	return {row['crm_id']: rowToPost(row) for row in STORE.query('SELECT * FROM properties')}
+
+
+def getState(crmID):
+	rows = STORE.query('SELECT * FROM properties WHERE crm_id = ?', (crmID,))
+	return rowToPost(rows[0]) if rows else None
+
+
+def upsert(connection, table, crmID, fields):
+	columns = ['crm_id'] + list(fields)
+	sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (crm_id) DO UPDATE SET %s' % (table, ', '.join(columns), ', '.join(['?'] * len(columns)), ', '.join('%s = excluded.%s' % (column, column) for column in fields))
+	connection.execute(sql, [crmID] + list(fields.values()))
+
+
+def upsertState(connection, crmID, fields):
+	upsert(connection, 'properties', crmID, fields)
 
 
+def updateState(crmID, **fields):
+	fields['last_synced'] = time.time()
+	with STORE.transaction() as connection:
+		upsertState(connection, crmID, fields)
+
+
+def deleteState(crmID):
+	with STORE.transaction() as connection:
+		connection.execute('DELETE FROM properties WHERE crm_id = ?', (crmID,))
+		connection.execute('DELETE FROM journal WHERE crm_id = ?', (crmID,))
+
+
+def journalStep(crmID, step, **fields):
+	# media uploaded for the job are kept until it's finished
+	fields.update(run=RUN_ID, step=step, updated=time.time())
+	with STORE.transaction() as connection:
+		upsert(connection, 'journal', crmID, fields)
+
+
+def getJournalMedia(url):
+	crmID = getattr(JOB, 'crmID', None)
+	rows = STORE.query('SELECT media FROM journal WHERE crm_id = ?', (crmID,))
+	return json.loads(rows[0]['media'] or '{}').get(url) if rows else None
+
+
+def journalMedia(url, mediaID):
+	crmID = getattr(JOB, 'crmID', None)
+	with STORE.transaction() as connection:
+		row = connection.execute('SELECT media FROM journal WHERE crm_id = ?', (crmID,)).fetchone()
+		if row:
+			media = json.loads(row['media'] or '{}')
+			media[url] = mediaID
+			connection.execute('UPDATE journal SET media = ? WHERE crm_id = ?', (json.dumps(media), crmID))
+
+
+def finishJob(crmID):
+	STORE.execute('DELETE FROM journal WHERE crm_id = ?', (crmID,))
+
+
+def failJob(crmID, error=None):
+	# the run is alive and knows the job failed, unlike an interrupted one. Its media are still reused next time
+	if isinstance(error, RequestMaybeDone):
+		# the post could be created. The next run checks the site as after an interruption
+		return
+	STORE.execute('UPDATE journal SET step = ? WHERE crm_id = ?', ('failed', crmID))
 
-def checkNewProperties():
+
+def resumeJobs():
+	# finish what the interrupted run left. Returns True if state was refreshed from the site
+	# failed jobs are synced again as usual, only jobs of a run which died are checked
+	rows = STORE.query('SELECT * FROM journal WHERE step IN (?, ?)', ('started', 'post_written'))
+	if not rows:
+		return False
+
+	log('Resuming %d unfinished jobs of run %s.' % (len(rows), rows[0]['run']), 'yellow')
+	refreshed = False
+	if any(row['step'] == 'started' and not (getState(row['crm_id']) or {}).get('id') for row in rows):
+		# new post could be written right before the run was interrupted
+		refreshStateFromSite()
+		refreshed = True
+
+	for row in rows:
+		post = getState(row['crm_id'])
+		if not post or not post['id'] or post['crm_updated'] != row['crm_updated']:
+			# post wasn't written. The property is synced again with the media uploaded before
+			journalStep(row['crm_id'], 'retry')
+			continue
+
+		debug('Property id=%s was written by the interrupted run. Attaching media.' % row['crm_id'])
+		attachMedia(post['id'], post['fave_property_images'] + post['fave_attachments'] + ([post['_thumbnail_id']] if post['_thumbnail_id'] else []))
+		finishJob(row['crm_id'])
+
+	return refreshed
+
+
+@contextmanager
+def runLock(path):
+	# cron starts the next run even if the previous one is still working
+	file = open(path, 'a')
 	try:
-		with open('crm.json', 'r') as file:
-			dataFromCRMOld = json.loads(file.read())
-	except OSError as e:
-		log('Cannot open the file %s. %s' % ('crm.json', e), 'red')
-		exit(-1)
+		fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		log('Another sync is running, %s is locked.' % path, 'yellow')
+		file.close()
+		exit(0)
 
-	dataFromCRM = getCRMPropertiesList()
-	dataFromSite = getSitePropertiesList()
+	try:
+		yield
+	finally:
+		fcntl.flock(file, fcntl.LOCK_UN)
+		file.close()
+
+
+def postState(post):
+	# columns filled from the post data
+	fields = {
+		'property_status': json.dumps(post.get('property_status')),
+		'thumbnail_id': post.get('_thumbnail_id') or None,
+		'thumbnail_name': post.get('_thumbnail_name')
+	}
+	for key in MEDIA_FIELDS:
+		fields[key] = json.dumps(post.get(key) or [])
 
-	for item in dataFromCRM:
-		for i, item2 in enumerate(dataFromCRMOld):
-			# work only with difference in items. ignore old entries.
-			if item['id'] != item2['id']:
-				if len(dataFromCRMOld) - 1 == i:
+	return fields
 
-					status = item['attributes']['status'].lower()
 
-					post = getPostByCRMID(item['id'], dataFromSite)
+@timed('state_refresh')
+def refreshStateFromSite(restored=False):
+	# drift check: the site knows better which posts and media exist
+	# restored means the site could be rolled back, so posts with other crm_updated than the state are written again
+	lastETag = getMeta('site_snapshot_etag')
+	try:
+		posts, etag = getSiteSnapshot(lastETag)
+		if posts is None:
+			debug('Site posts weren\'t changed since the last check.')
+			return
+	except LookupError as e:
+		debug('Site snapshot is not available (%s). Getting the list.' % e)
+		# only fields kept in the state are requested, not the whole post
+		posts = iterSiteProperties(fields=SITE_STATE_FIELDS)
+		etag = None
+
+	state = loadState()
+	rows = {}
 
-					if post and 'crm_id' in post and len(post['crm_id']) > 0:
-						debug('Property id=%s found.' % item['id'])
-						checkPropertyChanges(post, item)
-					else:
-						if status in ['active', 'let', 'under application', 'under offer', 'sold']:
-							pass
-						else:
-							# do not pass others
-							continue
+	for post in posts:
+		crmID = post.get('crm_id')
+		if not crmID:
+			# site posts which weren't created from CRM have empty crm_id
+			continue
+
+		fields = postState(post)
+		fields['post_id'] = post['id']
+		old = state.get(crmID)
+		if not old or old['id'] != post['id'] or not old['crm_updated']:
+			fields['crm_updated'] = post['crm_updated']
+		elif restored and old['crm_updated'] != post['crm_updated']:
+			debug('Post id=%s of property id=%s differs from the state.' % (post['id'], crmID))
+			fields['crm_updated'] = post['crm_updated']
+			fields['field_hashes'] = None
+		rows[crmID] = fields
+
+	with STORE.transaction() as connection:
+		for crmID, fields in rows.items():
+			upsertState(connection, crmID, fields)
+
+		for crmID, old in state.items():
+			if old['id'] and crmID not in rows:
+				debug('Post id=%s of property id=%s is not on the site anymore.' % (old['id'], crmID))
+				# the next diff sees the property as changed and creates the post again
+				upsertState(connection, crmID, {'post_id': None, 'crm_updated': None, 'field_hashes': None})
+
+		# the next check gets 304 if nothing was changed on the site
+		connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('site_snapshot_etag', etag))
+
+	debug('State was checked against %d site posts.' % len(rows))
+
+
+def syncProperty(item, post=None):
+	JOB.crmID = item['id']
+	start = time.perf_counter()
+	try:
+		syncItem(item, post)
+	finally:
+		METRICS.property(item['id'], time.perf_counter() - start)
 
-						debug('Submit new property.')
-						submitProperty(item)
 
-			else:
-				break
+def syncItem(item, post):
+	if post and post['id']:
+		debug('Property id=%s found.' % item['id'])
+		checkPropertyChanges(post, item)
+	else:
+		if item['attributes']['status'].lower() not in PUBLISHED_STATUSES:
+			# do not pass others, but remember them to skip until they are changed
+			updateState(item['id'], crm_updated=item['attributes']['updated_at'], crm_status=item['attributes']['status'], last_outcome='skipped')
+			return
+
+		debug('Submit new property.')
+		submitProperty(item)
+
+
+def getPriority(item, post, deadline=None):
+	# lower goes first: status changes and trash, OFI changes, new listings, other updates, updates with new media
+	prop = item['attributes']
+	if not post or not post['id']:
+		return (2, 0)
+	if prop['status'].lower() not in PUBLISHED_STATUSES:
+		return (0, 0)
+	# posts found on the site have no CRM status until they are synced, unknown is not a change
+	if post['crm_status'] and prop['status'].lower() != post['crm_status'].lower():
+		return (0, 0)
+	if deadline and time.monotonic() > deadline:
+		# won't be synced in this run anyway
+		return (3, 0)
+
+	# sub-resources tell what was changed
+	# the same responses are used by submitProperty afterwards
+	links = item['relationships']
+	try:
+		if hashPayload({'fw_options': getOFI(reqCached(links['inspections']['links']['related'], prop['updated_at']))}) != post['field_hashes'].get('ofi'):
+			return (1, 0)
+
+		images = reqCached(links['images']['links']['related'] + '?sort=position', prop['updated_at'])
+	except RequestFailed as e:
+		debug('Priority of property id=%s is unknown. %s' % (item['id'], e))
+		return (3, 0)
+
+	newMedia = len([image for image in images.get('data', []) if image['id'] not in post['crm_image_ids']])
+	if prop['primary_image'] and prop['primary_image'] != post['_thumbnail_name']:
+		newMedia += 1
+
+	return (4, newMedia) if newMedia else (3, 0)
+
+
+def prioritize(items, posts, deadline=None):
+	# yields items in the order of priority. Only PRIORITY_WINDOW items are sorted at once, so memory stays bounded
+	heap = []
+	rank = lambda item: (getPriority(item, posts.get(item['id']), deadline), item)
+
+	for count, (priority, item) in enumerate(iterPages(rank, items, FETCH_WORKERS)):
+		heapq.heappush(heap, (priority, count, item))
+		if len(heap) > PRIORITY_WINDOW:
+			yield heapq.heappop(heap)[2]
+
+	while heap:
+		yield heapq.heappop(heap)[2]
+
+
+@timed('sync')
+def syncProperties(items, posts, deadline=None, workers=SYNC_WORKERS, keepGoing=False):
+	# returns ids of items which weren't synced and ids of items which didn't fit into the time budget
+	# items can be a generator. Only a few of them wait for a worker, the rest are not fetched yet
+	# keepGoing counts fatal errors of a property as its failure instead of stopping the run
+	failed = set()
+	deferred = set()
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {}
+
+		def collect(done):
+			for future in done:
+				id = futures.pop(future)
+				try:
+					future.result()
+				except RequestFailed as e:
+					log('Property id=%s wasn\'t synced. %s' % (id, e), 'red')
+					updateState(id, last_outcome='failed')
+					failJob(id, e)
+					failed.add(id)
+				except (Exception, SystemExit) as e:
+					if not keepGoing:
+						# fatal error in one of the workers. Do not start the rest
+						executor.shutdown(cancel_futures=True)
+						raise
+
+					log('Property id=%s wasn\'t synced. %r' % (id, e), 'red')
+					updateState(id, last_outcome='failed')
+					failJob(id, e)
+					failed.add(id)
+
+		for item in items:
+			if deadline and time.monotonic() > deadline:
+				# the rest of items is still read to know which ones were removed
+				deferred.add(item['id'])
+				continue
+
+			if len(futures) >= workers * 2:
+				collect(wait(futures, return_when=FIRST_COMPLETED)[0])
+			futures[executor.submit(syncProperty, item, posts.get(item['id']))] = item['id']
+
+		collect(list(as_completed(futures)))
+
+	if deferred:
+		log('%d properties didn\'t fit into the time budget and wait for the next run.' % len(deferred), 'yellow')
+
+	return (failed, deferred)
+
+
+def getMeta(key):
+	rows = STORE.query('SELECT value FROM meta WHERE key = ?', (key,))
+	return rows[0]['value'] if rows else None
+
+
+def setMeta(key, value):
+	STORE.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+def isFullSyncDue():
+	lastFullSync = getMeta('last_full_sync')
+	return not lastFullSync or time.time() - float(lastFullSync) >= FULL_SYNC_INTERVAL
+
+
+def getWatermark(updated, failed, current):
+	# the next incremental run starts from here. updated is {crm id: updated_at} of received items
+	failedDates = [updated[id] for id in failed if id in updated]
+	if failedDates:
+		# go back to the oldest failed item to try it again
+		return min(failedDates, key=parseDate)
+
+	dates = list(updated.values())
+	if current:
+		dates.append(current)
+
+	return max(dates, key=parseDate) if dates else None
+
+
+def checkNewProperties(keepGoing=False):
+	deadline = time.monotonic() + SYNC_TIME_BUDGET if SYNC_TIME_BUDGET else None
+	watermark = getMeta('crm_watermark')
+	fullSync = not watermark or isFullSyncDue()
+	dataFromCRM = None
+	refreshed = resumeJobs() if PLAN is None else False
+
+	if not fullSync:
+		debug('Getting CRM items changed since %s.' % watermark)
+		dataFromCRM = getCRMChangedProperties(watermark)
+		fullSync = dataFromCRM is None
+
+	if fullSync:
+		debug('Full sync.')
+		if not refreshed:
+			refreshStateFromSite()
+		# items are synced while the next pages are coming
+		dataFromCRM = iterCRMProperties()
+
+	state = loadState()
+	updated = {}
+
+	# work only with difference in items. ignore old entries. Urgent changes go first
+	failed, deferred = syncProperties(prioritize(diffProperties(state, dataFromCRM, updated), state, deadline), state, deadline, keepGoing=keepGoing)
+
+	added = len([id for id in updated if id not in state])
+	changed = len([id for id in updated if id in state and updated[id] != state[id]['crm_updated']])
+	# only full list shows what was removed
+	removed = [post for id, post in state.items() if id not in updated] if fullSync else []
+	log('CRM diff: %d added, %d changed, %d removed' % (added, changed, len(removed)), 'yellow')
+
+	with METRICS.timer('trash'):
+		for post in removed:
+			try:
+				# a page shifted by a removal while the list was read can hide a live property
+				item = getProperty(post['crm_id'])
+				if item is not None:
+					debug('Property id=%s is still in CRM.' % post['crm_id'])
+					syncProperty(item, post)
+					continue
+			except RequestFailed as e:
+				log('Property id=%s wasn\'t checked. %s' % (post['crm_id'], e), 'red')
+				continue
+
+			if post['id']:
+				try:
+					if not trashProperty(post, 'removed from CRM'):
+						# try again next run
+						continue
+				except RequestFailed as e:
+					log('Property id=%s wasn\'t deleted. %s' % (post['id'], e), 'red')
+					continue
+
+			deleteState(post['crm_id'])
+
+	# the next run starts from deferred items
+	watermark = getWatermark(updated, failed | deferred, watermark)
+	if watermark:
+		setMeta('crm_watermark', watermark)
+	if fullSync and not deferred:
+		setMeta('last_full_sync', str(time.time()))
 
 
 def run():
 	debug('Start...', True)
-	checkNewProperties()
+
+	try:
+		checkNewProperties()
+	except RequestFailed as e:
+		log('Sync was interrupted. %s' % e, 'red')
+		exit(-1)
+
+
+def plan(output=None):
+	global PLAN
+	debug('Planning...', True)
+
+	# the sync runs as usual, but nothing is written to the site or to the state file
+	PLAN = Plan()
+	STORE.detach()
+
+	try:
+		checkNewProperties()
+	except RequestFailed as e:
+		log('Plan was interrupted. %s' % e, 'red')
+		exit(-1)
+
+	counts = PLAN.counts()
+	log('Plan: %d to create, %d to update, %d to trash, %d media to upload, %d media to delete' % (counts.get('create', 0), counts.get('update', 0), counts.get('trash', 0), counts.get('upload_media', 0), counts.get('delete_media', 0)), 'magenta')
+
+	result = json.dumps({'counts': counts, 'actions': PLAN.actions}, indent=1)
+	if output:
+		with open(output, 'w') as file:
+			file.write(result)
+		debug('Plan was written to %s.' % output)
+	else:
+		log(result)
+
+
+def backfill(batchSize, workers=SYNC_WORKERS, force=False):
+	debug('Start backfill...', True)
+
+	try:
+		backfillProperties(batchSize, workers, force)
+	except RequestFailed as e:
+		log('Backfill was interrupted. %s. Run it again to continue.' % e, 'red')
+		exit(-1)
+
+
+def backfillProperties(batchSize, workers, force):
+	# position in the CRM list is saved after every batch, so an interrupted backfill continues from there
+	checkpoint = json.loads(getMeta('backfill_checkpoint') or 'null')
+	resumeJobs()
+	if checkpoint and checkpoint['force'] == force:
+		offset = checkpoint['offset']
+		log('Continuing backfill from property %d.' % offset, 'yellow')
+	else:
+		offset = 0
+		# after a restore of the site neither its snapshot nor the state can be trusted
+		STORE.execute('DELETE FROM meta WHERE key = ?', ('site_snapshot_etag',))
+		refreshStateFromSite(restored=True)
+
+	total = getCRMTotal(getCRMPropertiesPage(0, 1), 1)
+	items = iterCRMProperties(start=offset)
+	# a listing added while the backfill runs shifts the pages, so the same item can come again
+	seen = set()
+	start = time.monotonic()
+	done = 0
+	failedCount = 0
+
+	while True:
+		batch = list(islice(items, batchSize))
+		if not batch:
+			break
+		offset += len(batch)
+
+		fresh = []
+		for item in batch:
+			if item['id'] not in seen:
+				seen.add(item['id'])
+				fresh.append(item)
+
+		# the state is read after the previous batch was written
+		posts = {}
+		for item in fresh:
+			post = getState(item['id'])
+			if post and force:
+				# posts look as if they were never synced, so every field is written again
+				post = dict(post, crm_updated=None, field_hashes={})
+			if post:
+				posts[item['id']] = post
+
+		# a listing which can't be written must not stop the backfill on every resume
+		failed, deferred = syncProperties(fresh, posts, workers=workers, keepGoing=True)
+		failedCount += len(failed)
+
+		done += len(fresh)
+		setMeta('backfill_checkpoint', json.dumps({'offset': offset, 'force': force}))
+
+		speed = done / (time.monotonic() - start) * 60
+		eta = ', ETA %s' % timedelta(seconds=int((total - offset) / speed * 60)) if total and total > offset and speed else ''
+		log('Backfill: %d%s properties, %.1f properties/min%s' % (offset, '/%d' % total if total else '', speed, eta), 'magenta')
+
+	STORE.execute('DELETE FROM meta WHERE key = ?', ('backfill_checkpoint',))
+	log('Backfill finished: %d properties in %s, %d failed.' % (done, timedelta(seconds=int(time.monotonic() - start)), failedCount), 'green')
+
+
+class WorkQueue:
+	# CRM ids waiting for sync. Events for the same id within the window are merged into one
+	def __init__(self, window):
+		self.window = window
+		self.pending = {}
+		self.running = set()
+		self.failures = {}
+		self.paused = False
+		self.condition = threading.Condition()
+
+	def push(self, crmID, item=None):
+		with self.condition:
+			if crmID in self.pending:
+				debug('Property id=%s is already queued.' % crmID)
+				due, queued = self.pending[crmID]
+				self.pending[crmID] = (due, item or queued)
+			else:
+				self.pending[crmID] = (time.monotonic() + self.window, item)
+			self.condition.notify_all()
+
+	def take(self):
+		# blocks until some id is due. The same id is never synced twice at once
+		with self.condition:
+			while True:
+				now = time.monotonic()
+				ready = [(due, crmID) for crmID, (due, item) in self.pending.items() if crmID not in self.running]
+				if ready and not self.paused:
+					due, crmID = min(ready)
+					if due <= now:
+						item = self.pending.pop(crmID)[1]
+						self.running.add(crmID)
+						return (crmID, item)
+					self.condition.wait(due - now)
+				else:
+					self.condition.wait()
+
+	def done(self, crmID, failed=False):
+		with self.condition:
+			self.running.discard(crmID)
+			if failed:
+				# try again later with fresh data. A newer event which is already queued goes as it is
+				self.failures[crmID] = self.failures.get(crmID, 0) + 1
+				if crmID not in self.pending:
+					delay = min(max(self.window, 1) * 2 ** self.failures[crmID], REQUEUE_MAX_DELAY)
+					debug('Property id=%s is queued again in %ds.' % (crmID, delay))
+					self.pending[crmID] = (time.monotonic() + delay, None)
+			else:
+				self.failures.pop(crmID, None)
+			self.condition.notify_all()
+
+	@contextmanager
+	def pause(self):
+		# stop workers and wait for the running syncs to finish
+		with self.condition:
+			self.paused = True
+			while self.running:
+				self.condition.wait()
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.paused = False
+				self.condition.notify_all()
+
+
+def syncPropertyByID(crmID, item=None):
+	if item is None:
+		item = getProperty(crmID)
+		if item is None:
+			log('Property id=%s is not in CRM.' % crmID, 'yellow')
+			post = getState(crmID)
+			if post and (not post['id'] or trashProperty(post, 'removed from CRM')):
+				deleteState(crmID)
+			return
+
+	syncProperty(item, getState(crmID))
+
+
+def syncWorker(queue):
+	while True:
+		crmID, item = queue.take()
+		failed = True
+		try:
+			syncPropertyByID(crmID, item)
+			failed = False
+		except RequestFailed as e:
+			log('Property id=%s wasn\'t synced. %s' % (crmID, e), 'red')
+			updateState(crmID, last_outcome='failed')
+			failJob(crmID, e)
+		except (Exception, SystemExit) as e:
+			# keep the daemon alive, the queue tries it again later
+			log('Property id=%s wasn\'t synced. %r' % (crmID, e), 'red')
+		finally:
+			queue.done(crmID, failed)
+
+
+def getWebhookIDs(payload):
+	# Eagle sends JSON:API resource, other senders may post just ids
+	if isinstance(payload, list):
+		return [id for entry in payload for id in getWebhookIDs(entry)]
+	if isinstance(payload, dict):
+		for key in ['data', 'ids', 'property']:
+			if key in payload:
+				return getWebhookIDs(payload[key])
+		if payload.get('type', 'properties') != 'properties':
+			return []
+		for key in ['property_id', 'id']:
+			if key in payload:
+				return getWebhookIDs(payload[key])
+		return []
+	if isinstance(payload, (str, int)) and str(payload).strip():
+		return [str(payload).strip()]
+
+	return []
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+	def do_POST(self):
+		url = urlsplit(self.path)
+		secret = self.headers.get('X-Webhook-Secret') or parse_qs(url.query).get('secret', [''])[0]
+		if WEBHOOK_SECRET and not hmac.compare_digest(secret, WEBHOOK_SECRET):
+			log('Webhook with wrong secret from %s.' % self.client_address[0], 'red')
+			self.reply(403, {'error': 'forbidden'})
+			return
+
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			ids = getWebhookIDs(json.loads(self.rfile.read(length) or 'null'))
+		except ValueError:
+			self.reply(400, {'error': 'invalid JSON'})
+			return
+
+		for crmID in ids:
+			self.server.queue.push(crmID)
+		debug('Webhook queued properties %s.' % ids)
+		self.reply(202, {'queued': ids})
+
+	def reply(self, status, body):
+		data = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		debug('Webhook: ' + format % args)
+
+
+def pollChanges(queue):
+	watermark = getMeta('crm_watermark')
+	if not watermark or isFullSyncDue():
+		# full sync also catches removed properties
+		with queue.pause():
+			checkNewProperties(keepGoing=True)
+		return
+
+	items = getCRMChangedProperties(watermark)
+	if items is None:
+		with queue.pause():
+			checkNewProperties(keepGoing=True)
+		return
+
+	updated = {}
+	queued = set()
+	for item in diffProperties(loadState(), items, updated):
+		queue.push(item['id'], item)
+		queued.add(item['id'])
+
+	# queued items aren't synced yet. The watermark passes them when a later poll finds them in the state
+	watermark = getWatermark(updated, queued, watermark)
+	if watermark:
+		setMeta('crm_watermark', watermark)
+
+
+def daemon():
+	debug('Start daemon...', True)
+	queue = WorkQueue(COALESCE_WINDOW)
+
+	for i in range(SYNC_WORKERS):
+		threading.Thread(target=syncWorker, args=(queue,), daemon=True).start()
+
+	if WEBHOOK_PORT:
+		server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+		server.queue = queue
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		log('Listening for webhooks on %s:%d' % (WEBHOOK_HOST, WEBHOOK_PORT), 'green')
+
+	try:
+		while True:
+			if POLL_INTERVAL:
+				try:
+					pollChanges(queue)
+				except (RequestFailed, SystemExit) as e:
+					log('Poll failed. %r' % e, 'red')
+			elif isFullSyncDue():
+				with queue.pause():
+					try:
+						checkNewProperties(keepGoing=True)
+					except (RequestFailed, SystemExit) as e:
+						log('Full sync failed. %r' % e, 'red')
+
+			METRICS.export()
+			time.sleep(POLL_INTERVAL or 60)
+	except KeyboardInterrupt:
+		log('Daemon stopped.', 'yellow')
 
 
 if __name__ == '__main__':
-	HEADERS_AUTH_EAGLE = {'Authorization': getEagleToken(), 'Content-Type': 'application/vnd.api+json'}
-	run()
-	debug('Task completed.', True)
\ No newline at end of file
+	parser = argparse.ArgumentParser(description='Sync Eagle CRM properties with WordPress.')
+	commands = parser.add_subparsers(dest='command')
+	commands.add_parser('sync', help='sync changed properties (default)')
+	commands.add_parser('audit', help='find site posts which are duplicated or not in CRM')
+	commands.add_parser('daemon', help='keep running and sync properties as soon as they change')
+	planParser = commands.add_parser('plan', help='show what sync would change on the site without changing it')
+	planParser.add_argument('--output', help='write the plan to this file as JSON')
+	backfillParser = commands.add_parser('backfill', help='sync the whole CRM catalogue in batches, continuing after interruption')
+	backfillParser.add_argument('--batch-size', type=int, default=100, help='properties between checkpoints')
+	backfillParser.add_argument('--workers', type=int, default=SYNC_WORKERS, help='properties synced at once')
+	backfillParser.add_argument('--force', action='store_true', help='write every property again, even if it wasn\'t changed')
+	args = parser.parse_args()
+
+	try:
+		if args.command == 'audit':
+			checkProperties()
+		elif args.command == 'plan':
+			plan(args.output)
+		else:
+			with runLock(LOCK_FILE):
+				if args.command == 'daemon':
+					daemon()
+				elif args.command == 'backfill':
+					backfill(args.batch_size, args.workers, args.force)
+				else:
+					run()
+	finally:
+		METRICS.summary()
+		METRICS.export()
+	debug('Eagle connections: %(opened)d opened, %(reused)d reused' % EAGLE.stats())
+	debug('WordPress connections: %(opened)d opened, %(reused)d reused' % WP.stats())
+	debug('Task completed.', True)
@@ -0,0 +1,166 @@
+<?php
+/**
+ * Plugin Name: CRM Sync Snapshot
+ * Description: Compact list of all properties for Eagle CRM sync script. GET /wp-json/crm-sync/v1/snapshot. Batchable media routes POST/DELETE /wp-json/crm-sync/v1/media/<id>
+ * Version: 1.1
+ */
+
+if (!defined('ABSPATH')) {
+	exit;
+}
+
+// meta with lists of ids. Houzez keeps some of them as one row per value
+define('CRM_SYNC_LIST_META', ['crm_image_ids', 'fave_property_images', 'crm_attachment_ids', 'fave_attachments']);
+
+add_action('rest_api_init', function () {
+	register_rest_route('crm-sync/v1', '/snapshot', [
+		'methods' => 'GET',
+		'callback' => 'crm_sync_snapshot',
+		'permission_callback' => function () {
+			return current_user_can('edit_posts');
+		}
+	]);
+
+	// core media routes can't be used in /batch/v1, these can
+	register_rest_route('crm-sync/v1', '/media/(?P<id>\d+)', [
+		[
+			'methods' => 'POST',
+			'callback' => 'crm_sync_attach_media',
+			'permission_callback' => function ($request) {
+				return current_user_can('edit_post', (int) $request['id']);
+			},
+			'args' => [
+				'post_parent' => ['type' => 'integer', 'required' => true]
+			]
+		],
+		[
+			'methods' => 'DELETE',
+			'callback' => 'crm_sync_delete_media',
+			'permission_callback' => function ($request) {
+				return current_user_can('delete_post', (int) $request['id']);
+			}
+		],
+		'allow_batch' => ['v1' => true]
+	]);
+});
+
+function crm_sync_meta_list($id, $key) {
+	$values = get_post_meta($id, $key, false);
+	if (count($values) == 1 && is_array($values[0])) {
+		$values = $values[0];
+	}
+
+	return array_values(array_filter($values, function ($value) {
+		return $value !== '' && $value !== null;
+	}));
+}
+
+function crm_sync_media_error($id) {
+	if (get_post_type($id) != 'attachment') {
+		return new WP_Error('rest_post_invalid_id', 'Invalid attachment ID.', ['status' => 404]);
+	}
+
+	return null;
+}
+
+function crm_sync_attach_media($request) {
+	$id = (int) $request['id'];
+	$error = crm_sync_media_error($id);
+	if ($error) {
+		return $error;
+	}
+
+	$result = wp_update_post(['ID' => $id, 'post_parent' => (int) $request['post_parent']], true);
+	if (is_wp_error($result)) {
+		return $result;
+	}
+
+	return new WP_REST_Response(['id' => $id, 'post_parent' => (int) $request['post_parent']]);
+}
+
+function crm_sync_delete_media($request) {
+	$id = (int) $request['id'];
+	$error = crm_sync_media_error($id);
+	if ($error) {
+		return $error;
+	}
+
+	if (!wp_delete_attachment($id, true)) {
+		return new WP_Error('rest_cannot_delete', 'The attachment cannot be deleted.', ['status' => 500]);
+	}
+
+	return new WP_REST_Response(['deleted' => true, 'id' => $id]);
+}
+
+function crm_sync_term_ids($id, $taxonomy) {
+	$terms = get_the_terms($id, $taxonomy);
+	if (!is_array($terms)) {
+		return [];
+	}
+
+	return array_map('intval', wp_list_pluck($terms, 'term_id'));
+}
+
+function crm_sync_snapshot() {
+	$ids = get_posts([
+		'post_type' => 'property',
+		'post_status' => 'publish',
+		'posts_per_page' => -1,
+		'fields' => 'ids',
+		'orderby' => 'ID',
+		'order' => 'ASC',
+		'no_found_rows' => true
+	]);
+
+	// one query for meta and one for terms of all posts. get_the_terms() reads the term cache filled here
+	update_meta_cache('post', $ids);
+	update_object_term_cache($ids, 'property');
+
+	$posts = [];
+	foreach ($ids as $id) {
+		$post = [
+			'id' => $id,
+			'crm_id' => get_post_meta($id, 'crm_id', true),
+			'crm_updated' => get_post_meta($id, 'crm_updated', true),
+			'property_status' => crm_sync_term_ids($id, 'property_status'),
+			'_thumbnail_id' => (int) get_post_meta($id, '_thumbnail_id', true),
+			'_thumbnail_name' => get_post_meta($id, '_thumbnail_name', true)
+		];
+		foreach (CRM_SYNC_LIST_META as $key) {
+			$post[$key] = crm_sync_meta_list($id, $key);
+		}
+		$posts[] = $post;
+	}
+
+	return new WP_REST_Response($posts);
+}
+
+// the list is sent as is: with ETag, 304 if it wasn't changed and gzip if client accepts it
+add_filter('rest_pre_serve_request', function ($served, $result, $request) {
+	if ($served || $request->get_route() != '/crm-sync/v1/snapshot' || $result->is_error()) {
+		return $served;
+	}
+
+	$body = wp_json_encode($result->get_data());
+	$etag = '"' . md5($body) . '"';
+
+	header('ETag: ' . $etag);
+	header('Cache-Control: private, no-cache');
+	header('Vary: Accept-Encoding');
+
+	if (trim($request->get_header('if_none_match')) == $etag) {
+		status_header(304);
+		return true;
+	}
+
+	header('Content-Type: application/json; charset=' . get_option('blog_charset'));
+	if (function_exists('gzencode') && strpos((string) $request->get_header('accept_encoding'), 'gzip') !== false && !ini_get('zlib.output_compression')) {
+		header('Content-Encoding: gzip');
+		$body = gzencode($body, 6);
+	}
+
+	header('Content-Length: ' . strlen($body));
+	echo $body;
+
+	return true;
+}, 10, 3);